@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for git-blamegrep.
+
+Generates a synthetic git repository (locally, with git fast-import), runs a
+set of representative searches against it and writes the timings as JSON so
+that runs of different versions can be compared.
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Set, Tuple
+
+
+SCRIPT = Path(__file__).resolve().with_name('git-blamegrep.py')
+
+# Markers sprinkled into the generated files: the rare one is on about one
+# line in RARE_EVERY, the dense one on about one line in DENSE_EVERY.
+RARE_MARKER = 'XYZZY'
+RARE_EVERY = 5000
+DENSE_MARKER = 'TODO'
+DENSE_EVERY = 10
+
+WORDS = [
+    'alpha', 'beta', 'gamma', 'delta', 'value', 'index', 'result', 'buffer',
+    'return', 'import', 'self', 'count', 'items', 'lookup', 'parse', 'print',
+]
+
+# Name, arguments. {author} is replaced with the name of the first author.
+QUERIES = [
+    ('rare', [RARE_MARKER]),
+    ('dense', [DENSE_MARKER]),
+    ('author', [DENSE_MARKER, '--author', '{author}']),
+    ('context', [RARE_MARKER, '-C', '3']),
+    ('multi-pattern', ['-e', RARE_MARKER, '-e', DENSE_MARKER, '-e', 'lookup\\(']),
+    ('no-prefilter', [RARE_MARKER, '--no-prefilter']),
+]
+
+
+def load_blamegrep(path: Path):
+    """Import git-blamegrep.py as a module. The file name isn't a valid module name."""
+    spec = importlib.util.spec_from_file_location('blamegrep', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def random_line(rng: random.Random) -> str:
+    words = rng.choices(WORDS, k=rng.randint(2, 8))
+    roll = rng.randrange(RARE_EVERY)
+    if roll == 0:
+        words.append(RARE_MARKER)
+    elif roll % DENSE_EVERY == 0:
+        words.insert(0, f'# {DENSE_MARKER}')
+    return ' '.join(words)
+
+
+def generate_repo(
+    path: Path,
+    files: int,
+    lines: int,
+    commits: int,
+    authors: int,
+    changes: int,
+    seed: int
+) -> None:
+    """
+    Create a repository at path with the given number of files of about
+    lines lines each, built up over commits commits by authors authors. Each
+    commit after the first rewrites and adds a few lines in changes files.
+    The same parameters always give the same repository.
+    """
+    rng = random.Random(seed)
+    path.mkdir(parents=True)
+    subprocess.run(['git', 'init', '-q', '-b', 'main', str(path)], check=True)
+
+    contents = {
+        f'src/module{i // 100}/file{i}.py': [random_line(rng) for _ in range(lines)]
+        for i in range(files)
+    }
+    names = [(f'Author {i}', f'author{i}@example.com') for i in range(authors)]
+
+    proc = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=path, stdin=subprocess.PIPE)
+
+    def data(text: str) -> bytes:
+        encoded = text.encode('utf-8')
+        return b'data %d\n' % len(encoded) + encoded + b'\n'
+
+    timestamp = 1_600_000_000
+    for mark in range(1, commits + 1):
+        name, email = rng.choice(names)
+        timestamp += rng.randint(60, 86400)
+        out = io.BytesIO()
+        out.write(b'commit refs/heads/main\nmark :%d\n' % mark)
+        for role in (b'author', b'committer'):
+            out.write(b'%s %s <%s> %d +0000\n' % (role, name.encode(), email.encode(), timestamp))
+        out.write(data(f'Commit {mark}'))
+        if mark == 1:
+            changed = list(contents)
+        else:
+            out.write(b'from :%d\n' % (mark - 1))
+            changed = rng.sample(list(contents), min(changes, len(contents)))
+            for filepath in changed:
+                file_lines = contents[filepath]
+                for _ in range(rng.randint(1, 5)):
+                    file_lines[rng.randrange(len(file_lines))] = random_line(rng)
+                for _ in range(rng.randint(0, 3)):
+                    file_lines.insert(rng.randint(0, len(file_lines)), random_line(rng))
+        for filepath in changed:
+            out.write(b'M 100644 inline %s\n' % filepath.encode())
+            out.write(data('\n'.join(contents[filepath]) + '\n'))
+        proc.stdin.write(out.getvalue())
+
+    proc.stdin.close()
+    if proc.wait() != 0:
+        raise SystemExit('git fast-import failed')
+    subprocess.run(['git', 'reset', '-q', '--hard', 'main'], cwd=path, check=True)
+
+
+def time_runs(func: Callable[[], object], repeat: int) -> Dict[str, object]:
+    """Call func repeat times and return the wall-clock times in seconds."""
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        runs.append(time.perf_counter() - start)
+    return {'runs': runs, 'min': min(runs), 'median': statistics.median(runs)}
+
+
+def call_main(blamegrep, cwd: Path, args: List[str], stdout) -> Tuple[object, str]:
+    """Run git-blamegrep's main() in cwd and return its exit status and stderr."""
+    old_argv, old_cwd = sys.argv, os.getcwd()
+    sys.argv = ['git-blamegrep.py'] + args
+    os.chdir(cwd)
+    stderr = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                code = blamegrep.main()
+            except SystemExit as e:
+                code = e.code
+    finally:
+        sys.argv = old_argv
+        os.chdir(old_cwd)
+    return code, stderr.getvalue()
+
+
+def run_main(blamegrep, repo: Path, args: List[str]) -> None:
+    """
+    Run git-blamegrep's main() in repo with its output thrown away.
+    Exits if the search fails; exit status 1 only means there were no matches.
+    """
+    with open(os.devnull, 'w') as devnull:
+        code, stderr = call_main(blamegrep, repo, args, devnull)
+    if code not in (None, 0, 1):
+        raise SystemExit(f"git-blamegrep.py {' '.join(args)} failed with exit status {code}:\n{stderr}")
+
+
+def supported_options(blamegrep) -> Set[str]:
+    """Return the command line options that the git-blamegrep.py being benchmarked accepts."""
+    help_text = io.StringIO()
+    call_main(blamegrep, Path.cwd(), ['--help'], help_text)
+    return set(re.findall(r'(?<![\w-])(--?[a-zA-Z][\w-]*)', help_text.getvalue()))
+
+
+def bench_blame(blamegrep, repo: Path, count: int, repeat: int) -> Dict[str, Dict[str, object]]:
+    """
+    Time git_blame_file on the count largest files, and plain git blame on
+    the same files. The difference is the cost of parsing the output.
+    """
+    sizes = []
+    for filepath in repo.glob('src/*/*.py'):
+        sizes.append((filepath.stat().st_size, filepath.relative_to(repo).as_posix()))
+    largest = [filepath for _, filepath in sorted(sizes, reverse=True)[:count]]
+
+    def parse():
+        for filepath in largest:
+            blamegrep.git_blame_file(filepath, repo)
+
+    def raw():
+        for filepath in largest:
+            subprocess.run(['git', 'blame', '--porcelain', '--', filepath], cwd=repo, capture_output=True)
+
+    results = {
+        'git_blame_file': time_runs(parse, repeat),
+        'git blame --porcelain': time_runs(raw, repeat),
+    }
+    results['git_blame_file']['files'] = len(largest)
+    return results
+
+
+def compare(results: Dict[str, Dict[str, object]], baseline_path: str) -> None:
+    """Print how the median times changed since a baseline run."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)['results']
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        if 'median' not in result or 'median' not in baseline[name]:
+            continue
+        old, new = baseline[name]['median'], result['median']
+        change = (new - old) / old * 100 if old else 0.0
+        print(f"{name:<24} {old:8.3f}s -> {new:8.3f}s ({change:+.1f}%)", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark git-blamegrep against a generated repository.',
+        epilog='Example: bench.py --output before.json, then bench.py --baseline before.json'
+    )
+
+    parser.add_argument(
+        '--files',
+        type=int,
+        default=200,
+        help='Number of files in the generated repository (default: 200)'
+    )
+
+    parser.add_argument(
+        '--lines',
+        type=int,
+        default=300,
+        help='Initial number of lines per file (default: 300)'
+    )
+
+    parser.add_argument(
+        '--commits',
+        type=int,
+        default=500,
+        help='Number of commits in the history (default: 500)'
+    )
+
+    parser.add_argument(
+        '--authors',
+        type=int,
+        default=5,
+        help='Number of distinct authors (default: 5)'
+    )
+
+    parser.add_argument(
+        '--changes',
+        type=int,
+        default=3,
+        help='Number of files changed by each commit (default: 3)'
+    )
+
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=1,
+        help='Random seed for the generated repository (default: 1)'
+    )
+
+    parser.add_argument(
+        '--repo-dir',
+        default=os.path.join(os.environ.get('TMPDIR', '/tmp'), 'blamegrep-bench'),
+        help='Directory for generated repositories, which are reused between runs '
+             '(default: $TMPDIR/blamegrep-bench)'
+    )
+
+    parser.add_argument(
+        '--script',
+        default=str(SCRIPT),
+        help='git-blamegrep.py to benchmark (default: the one next to this file)'
+    )
+
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=3,
+        help='Number of times to run each benchmark (default: 3)'
+    )
+
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Pass -j N to every search (default: 1)'
+    )
+
+    parser.add_argument(
+        '--warm',
+        action='store_true',
+        help='Let searches use the blame cache instead of passing --no-cache'
+    )
+
+    parser.add_argument(
+        '--blame-files',
+        type=int,
+        default=20,
+        help='Number of files for the git_blame_file benchmark (default: 20)'
+    )
+
+    parser.add_argument(
+        '-o', '--output',
+        help='Write the results to this JSON file instead of stdout'
+    )
+
+    parser.add_argument(
+        '--baseline',
+        metavar='FILE',
+        help='Compare the results with an earlier JSON output'
+    )
+
+    args = parser.parse_args()
+
+    params = {
+        'files': args.files,
+        'lines': args.lines,
+        'commits': args.commits,
+        'authors': args.authors,
+        'changes': args.changes,
+        'seed': args.seed,
+    }
+    repo = Path(args.repo_dir) / '-'.join(f'{key}{value}' for key, value in params.items())
+    if not repo.exists():
+        print(f"Generating {repo}", file=sys.stderr)
+        start = time.perf_counter()
+        generate_repo(repo, **params)
+        print(f"Generated in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+    blamegrep = load_blamegrep(Path(args.script))
+    # Older versions don't have all the options, leave out what they lack
+    options = supported_options(blamegrep)
+    extra = ['--no-index']
+    if not args.warm:
+        extra.append('--no-cache')
+    extra = [arg for arg in extra if arg in options]
+    if '-j' in options:
+        extra = ['-j', str(args.jobs)] + extra
+
+    results: Dict[str, Dict[str, object]] = {}
+    for name, query in QUERIES:
+        query = [arg.replace('{author}', 'Author 0') for arg in query]
+        missing = list(dict.fromkeys(arg for arg in query if arg.startswith('-') and arg not in options))
+        if missing:
+            print(f"Skipping {name}: {', '.join(missing)} not supported", file=sys.stderr)
+            results[name] = {'skipped': f"{', '.join(missing)} not supported", 'args': query}
+            continue
+        print(f"Running {name}", file=sys.stderr)
+        results[name] = time_runs(lambda: run_main(blamegrep, repo, query + extra), args.repeat)
+        results[name]['args'] = query + extra
+
+    print("Running git_blame_file", file=sys.stderr)
+    results.update(bench_blame(blamegrep, repo, args.blame_files, args.repeat))
+
+    git_version = subprocess.run(['git', '--version'], capture_output=True, text=True).stdout.strip()
+    report = {
+        'script': str(Path(args.script).resolve()),
+        'python': platform.python_version(),
+        'git': git_version,
+        'repo': params,
+        'results': results,
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        compare(results, args.baseline)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
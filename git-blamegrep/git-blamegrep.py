@@ -5,11 +5,57 @@ Combines git blame functionality with grep-like pattern matching.
 """
 
 import argparse
+import codecs
+import cProfile
+import csv
+import fnmatch
+import heapq
+import json
+import os
 import re
+import sqlite3
 import subprocess
 import sys
+import threading
+import time
+from array import array
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Optional, List, Tuple
+from typing import Callable, Dict, Iterable, Iterator, NamedTuple, Optional, List, Set, Tuple, TypeVar
+
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+# Above this many -L ranges it's cheaper (and safer for the command line
+# length) to blame the whole file.
+MAX_BLAME_RANGES = 500
+
+# When sweeping over revisions, at most this many changed files are given to
+# git grep by name. Above that the whole tree is searched.
+MAX_GREP_PATHS = 1000
+
+# If more author names than this match --author, the author-first plan is
+# unlikely to narrow the search down much, so it's skipped.
+MAX_PLAN_AUTHORS = 100
+
+DEFAULT_MAX_SIZE_KB = 1024
+# Like git, a file is binary if there's a NUL byte in its first 8000 bytes
+BINARY_SNIFF_BYTES = 8000
+
+CACHE_DIR_NAME = 'blamegrep-cache'
+INDEX_DIR_NAME = 'blamegrep-index'
+DEFAULT_CACHE_SIZE_MB = 256
+
+# Number of slowest files listed by --stats
+STATS_SLOWEST_FILES = 10
+
+# Columns of --format ndjson and csv records. 'rev' is added in front when
+# sweeping over revisions.
+RECORD_FIELDS = ['file', 'line', 'commit', 'author', 'author_mail', 'author_time', 'match', 'patterns', 'content']
+CACHE_BATCH_SIZE = 1000
 
 
 def run_git_command(args: List[str], cwd: Optional[Path] = None) -> str:
@@ -28,72 +74,1468 @@ def run_git_command(args: List[str], cwd: Optional[Path] = None) -> str:
         sys.exit(1)
 
 
-def get_tracked_files(path: Optional[str] = None, cwd: Optional[Path] = None) -> List[str]:
-    """Get list of tracked files in the repository."""
-    args = ['ls-files']
-    if path:
-        args.append(path)
+class TreeEntry(NamedTuple):
+    path: str
+    # Blob SHA and size in bytes, None for files that aren't in the tree
+    blob: Optional[str]
+    size: Optional[int]
+
+
+def list_tree_files(rev: str, paths: List[str], cwd: Optional[Path] = None) -> List[TreeEntry]:
+    """
+    List the files in the tree of rev with their blob SHAs and sizes, using
+    one git ls-tree call. Like git ls-files, the listing is limited to paths
+    or to the current directory, and paths are relative to it.
+    """
+    output = run_git_command(['ls-tree', '-r', '-l', '-z', rev, '--'] + paths, cwd)
+    files = []
+    for record in output.split('\0'):
+        if not record:
+            continue
+        info, filepath = record.split('\t', 1)
+        _, object_type, blob, size = info.split()
+        # Skip submodules
+        if object_type == 'blob':
+            files.append(TreeEntry(filepath, blob, int(size)))
+    return files
+
 
-    output = run_git_command(args, cwd)
-    return [f for f in output.strip().split('\n') if f]
+def list_staged_new_files(paths: List[str], cwd: Optional[Path] = None) -> List[TreeEntry]:
+    """
+    List the files that are added in the index but not committed yet, under
+    paths or the current directory, with paths relative to it.
+    """
+    output = run_git_command(
+        ['diff', '--cached', '--relative', '--no-renames', '--diff-filter=A', '--name-only', '-z', '--'] + paths,
+        cwd
+    )
+    return [TreeEntry(path, None, None) for path in output.split('\0') if path]
 
 
-def git_blame_file(filepath: str, cwd: Optional[Path] = None) -> List[Tuple[str, str, int, str]]:
+def get_tracked_files(paths: List[str], cwd: Optional[Path] = None) -> List[TreeEntry]:
     """
-    Run git blame on a file and return blame information.
-    Returns list of tuples: (commit_hash, author, line_number, line_content)
+    Get list of files to search in the working tree: the files committed at
+    HEAD under paths, the new files staged under them, and any paths that
+    are files themselves. Files that aren't committed yet have no blob;
+    blame reports their lines as "Not Committed Yet".
     """
-    try:
-        # Use porcelain format for easier parsing
-        output = run_git_command(['blame', '--line-porcelain', filepath], cwd)
-    except:
-        return []
-
-    results = []
-    lines = output.split('\n')
-    i = 0
-
-    while i < len(lines):
-        if not lines[i]:
-            i += 1
+    if not paths:
+        return sorted(list_tree_files('HEAD', [], cwd) + list_staged_new_files([], cwd))
+
+    files = []
+    for path in paths:
+        path_obj = Path(path)
+        if path_obj.is_file():
+            # Keep files that aren't committed yet
+            files.extend(list_tree_files('HEAD', [path], cwd) or [TreeEntry(path, None, None)])
+        elif path_obj.is_dir():
+            files.extend(sorted(list_tree_files('HEAD', [path], cwd) + list_staged_new_files([path], cwd)))
+        else:
+            print(f"Warning: {path} not found", file=sys.stderr)
+    return files
+
+
+def repo_prefix(cwd: Optional[Path] = None) -> str:
+    """Return the path of cwd relative to the repository root, e.g. 'src/' ('' at the root)."""
+    return run_git_command(['rev-parse', '--show-prefix'], cwd).strip()
+
+
+def author_touched_files(
+    author_pattern: re.Pattern,
+    cwd: Optional[Path] = None,
+    rev: Optional[str] = None
+) -> Optional[Set[str]]:
+    """
+    Find the files that can contain lines blamed on an author matching
+    author_pattern: every file changed by one of their commits up to rev,
+    followed through later renames, plus files with uncommitted changes if
+    rev is None (the working tree).
+    Paths are relative to the repository root. Returns None if the plan
+    wouldn't narrow the search down.
+    """
+    history = [rev or 'HEAD']
+    # Match the pattern against the author names in Python so that it means
+    # exactly the same as when filtering blame output. %aN is the mailmapped
+    # name that blame shows, %an the raw name that's in the commit.
+    result = subprocess.run(
+        ['git', 'log', '--format=%aN%x00%an'] + history,
+        cwd=cwd, capture_output=True, text=True, errors='replace'
+    )
+    if result.returncode != 0:
+        return None
+    names = set()
+    for line in set(result.stdout.splitlines()):
+        mapped, _, raw = line.partition('\0')
+        if author_pattern.search(mapped):
+            names.update((mapped, raw))
+    if len(names) > MAX_PLAN_AUTHORS:
+        return None
+
+    files: Set[str] = set()
+    if names:
+        # Fixed-string "Name <" matches a superset of the commits by these authors
+        args = ['git', 'log', '-F', '--no-renames', '--name-only', '--format=', '-z']
+        args += [f'--author={name} <' for name in names] + history
+        result = subprocess.run(args, cwd=cwd, capture_output=True)
+        if result.returncode != 0:
+            return None
+        files.update(os.fsdecode(f).strip('\n') for f in result.stdout.split(b'\0'))
+        files.discard('')
+
+        # Blame follows a file through renames, so the author's lines can
+        # live under a name they never touched themselves
+        result = subprocess.run(
+            ['git', 'log', '--reverse', '-M', '--diff-filter=R', '--name-status', '--format=', '-z'] + history,
+            cwd=cwd, capture_output=True
+        )
+        if result.returncode != 0:
+            return None
+        fields = [os.fsdecode(f).strip('\n') for f in result.stdout.split(b'\0')]
+        # Records are "R<score>\0<old>\0<new>"
+        i = 0
+        while i < len(fields) - 2:
+            if not fields[i]:
+                i += 1
+                continue
+            if fields[i + 1] in files:
+                files.add(fields[i + 2])
+            i += 3
+
+    if rev is None:
+        # Uncommitted lines are blamed on "Not Committed Yet"
+        result = subprocess.run(['git', 'diff', '--name-only', '-z', 'HEAD'], cwd=cwd, capture_output=True)
+        if result.returncode == 0:
+            files.update(os.fsdecode(f) for f in result.stdout.split(b'\0') if f)
+
+    return files
+
+
+def pcre_agrees(pattern: str, ignore_case: bool) -> bool:
+    """
+    Check that git grep -P matches pattern on exactly the lines Python's re
+    does. Depending on the git version and locale, PCRE may not run in
+    UTF mode: then \\w, \\b, \\d and \\s are ASCII-only, '.' and negated
+    classes match a single byte of a multibyte character, and case-folding
+    only covers ASCII. git grep also sees the \r of CRLF line endings, which
+    blame output read as text doesn't have, so $ and \Z can fail before it.
+    Patterns that could tell the difference aren't safe to prefilter with.
+    """
+    # Python folds i, k and s to non-ASCII letters as well (e.g. the Kelvin sign)
+    if ignore_case or re.search(r'\(\?[a-zA-Z]*i', pattern):
+        unicode_folds = set('iksIKS')
+    else:
+        unicode_folds = set()
+
+    tokens = re.findall(r'\\.|.', pattern, re.DOTALL)
+    in_class = negated = False
+    class_start = 0
+    for i, token in enumerate(tokens):
+        following = tokens[i + 1] if i + 1 < len(tokens) else ''
+        if not token.isascii():
+            return False
+        if token[0] == '\\':
+            if token[1:] in ('w', 'W', 'b', 'B', 'd', 'D', 's', 'S', 'x', 'u', 'U', 'N', '0', 'Z'):
+                return False
             continue
+        if token in unicode_folds:
+            return False
+        if in_class:
+            if token == ']' and i > class_start:
+                in_class = False
+                # A negated class could match part of a character unless repeated
+                if negated and following not in ('*', '+'):
+                    return False
+            elif token == '-' and unicode_folds and i > class_start and following not in (']', ''):
+                # A range like a-z covers the letters with non-ASCII folds
+                low, high = tokens[i - 1][-1], following[-1]
+                if any(low <= c <= high for c in unicode_folds):
+                    return False
+        elif token == '[':
+            in_class = True
+            negated = following == '^'
+            class_start = i + 2 if negated else i + 1
+        elif token == '.' and following not in ('*', '+'):
+            return False
+        elif token == '$':
+            return False
+        elif token == '{' and following == ',':
+            # {,n} is a repeat in Python but literal text in older PCRE
+            return False
+    return True
+
+
+def grep_candidate_lines(
+    patterns: List[str],
+    paths: List[str],
+    ignore_case: bool,
+    cwd: Optional[Path] = None,
+    rev: Optional[str] = None,
+    literal_paths: bool = False
+) -> Optional[Dict[str, List[int]]]:
+    """
+    Find the lines that can match any of patterns with a single git grep pass
+    over the working tree, or over the tree of rev if given.
+    Returns a dict of normalized filepath -> sorted line numbers, or None if
+    git grep can't evaluate the pattern (e.g. git built without PCRE).
+    """
+    args = ['git']
+    if literal_paths:
+        args.append('--literal-pathspecs')
+    # -P is the closest match for Python's regex syntax. -a keeps binary files
+    # in the results like a full blame would.
+    args += ['grep', '-P', '-n', '-z', '-a', '--no-color']
+    if ignore_case:
+        args.append('-i')
+    for pattern in patterns:
+        args += ['-e', pattern]
+    if rev:
+        args.append(rev)
+    args += ['--'] + paths
+
+    result = subprocess.run(args, cwd=cwd, capture_output=True)
+    if result.returncode == 1:
+        return {}
+    if result.returncode != 0:
+        return None
 
-        # First line: commit hash, original line, final line, num lines
-        parts = lines[i].split()
-        if not parts:
-            i += 1
+    candidates: Dict[str, List[int]] = {}
+    for record in result.stdout.split(b'\n'):
+        if not record:
             continue
+        # Output is "<file>\0<line number>\0<content>"
+        filename, line_num, _ = record.split(b'\0', 2)
+        filename = os.fsdecode(filename)
+        if rev:
+            # Files in a tree are reported as "<rev>:<file>"
+            filename = filename[len(rev) + 1:]
+        candidates.setdefault(filename, []).append(int(line_num))
+
+    return candidates
+
+
+def to_line_ranges(line_numbers: List[int], context: int = 0) -> List[Tuple[int, int]]:
+    """
+    Collapse sorted line numbers into inclusive (start, end) ranges, widened
+    by context lines on both sides.
+    """
+    ranges: List[Tuple[int, int]] = []
+    for line_num in line_numbers:
+        start, end = max(1, line_num - context), line_num + context
+        if ranges and start <= ranges[-1][1] + 1:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end))
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+class CommitInfo(NamedTuple):
+    author: str
+    author_mail: str
+    author_time: int
+
+
+class CommitTable:
+    """
+    Author metadata of every commit seen during a run, shared by all files.
+    Strings are interned so that blame rows only carry references to them.
+    """
+
+    def __init__(self):
+        self.commits: Dict[str, CommitInfo] = {}
+
+    def __contains__(self, commit_hash: str) -> bool:
+        return commit_hash in self.commits
+
+    def __len__(self) -> int:
+        return len(self.commits)
+
+    def get(self, commit_hash: str) -> Optional[CommitInfo]:
+        return self.commits.get(commit_hash)
+
+    def add(self, commit_hash: str, author: str, author_mail: str, author_time: int) -> CommitInfo:
+        """Record a commit unless it's already known, and return its metadata."""
+        info = self.commits.get(commit_hash)
+        if info is None:
+            info = CommitInfo(sys.intern(author), sys.intern(author_mail), author_time)
+            # setdefault keeps this safe when several threads race on the same commit
+            info = self.commits.setdefault(sys.intern(commit_hash), info)
+        return info
+
+
+class Stats:
+    """
+    Wall-clock and CPU time spent in each phase of a search, and counters of
+    files and bytes, for --stats. Safe to update from worker threads. CPU
+    time is measured per thread, so with -j it can add up to more than the
+    wall-clock time.
+    """
+
+    def __init__(self, detailed: bool = False, slowest: int = STATS_SLOWEST_FILES):
+        # Timing every blame row costs a little, so it's only done on request
+        self.detailed = detailed
+        self.slowest_count = slowest
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.phases: Dict[str, List[float]] = {}
+        self.counters: Counter = Counter()
+        self.slowest: List[Tuple[float, str]] = []
+
+    @contextmanager
+    def phase(self, name: str):
+        """Add the time spent in the with block to phase name."""
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - wall, time.thread_time() - cpu)
+
+    def add_time(self, name: str, wall: float, cpu: float):
+        with self.lock:
+            totals = self.phases.setdefault(name, [0.0, 0.0])
+            totals[0] += wall
+            totals[1] += cpu
+
+    def count(self, name: str, n: int = 1):
+        with self.lock:
+            self.counters[name] += n
+
+    def timed(self, name: str, rows: Iterable[T], filepath: Optional[str] = None) -> Iterable[T]:
+        """
+        Add the time spent producing rows (but not consuming them) to phase
+        name. If filepath is given, the total also counts towards the
+        slowest files. Returns rows unchanged unless detailed stats are on.
+        """
+        if not self.detailed:
+            return rows
+        return self._timed(name, rows, filepath)
+
+    def _timed(self, name: str, rows: Iterable[T], filepath: Optional[str]) -> Iterator[T]:
+        wall = cpu = 0.0
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        for row in rows:
+            wall += time.perf_counter() - wall_start
+            cpu += time.thread_time() - cpu_start
+            yield row
+            wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        wall += time.perf_counter() - wall_start
+        cpu += time.thread_time() - cpu_start
+
+        self.add_time(name, wall, cpu)
+        if filepath is not None:
+            with self.lock:
+                if len(self.slowest) < self.slowest_count:
+                    heapq.heappush(self.slowest, (wall, filepath))
+                else:
+                    heapq.heappushpop(self.slowest, (wall, filepath))
+
+    def report(self, matches: int) -> str:
+        """Summarize the run for --stats."""
+        wall = time.perf_counter() - self.started
+        times = os.times()
+        lines = [
+            f"Time: {wall:.3f}s wall, {time.process_time():.3f}s CPU, "
+            f"{times.children_user + times.children_system:.3f}s CPU in git processes"
+        ]
+
+        phases = {name: list(totals) for name, totals in self.phases.items()}
+        # Searching a file is blaming it and matching the rows
+        if 'search' in phases:
+            search = phases.pop('search')
+            blame = phases.get('blame', [0.0, 0.0])
+            phases['match'] = [max(search[0] - blame[0], 0.0), max(search[1] - blame[1], 0.0)]
+        lines.append("Phases (wall / CPU):")
+        for name, (phase_wall, phase_cpu) in phases.items():
+            lines.append(f"  {name:<12} {phase_wall:8.3f}s {phase_cpu:8.3f}s")
+
+        counters = self.counters
+        lines.append(
+            f"Files: {counters['listed']} listed, {counters['not touched by author']} not touched by author, "
+            f"{counters['skipped']} skipped, "
+            f"{counters['no candidates']} without candidate lines, {counters['unchanged']} unchanged, "
+            f"{counters['index']} from index, {counters['cache']} from cache, {counters['blamed']} blamed"
+        )
+        lines.append(f"Parsed {counters['blame bytes']} bytes of git blame output")
+        lines.append(f"Matches: {matches} ({matches / wall if wall > 0 else 0:.1f}/s)")
+
+        if self.slowest:
+            lines.append("Slowest files (wall):")
+            for file_wall, filepath in sorted(self.slowest, reverse=True):
+                lines.append(f"  {file_wall:8.3f}s {filepath}")
+        return '\n'.join(lines)
+
+
+class CatFile:
+    """A long-running git cat-file --batch process that reads objects by id."""
+
+    def __init__(self, cwd: Optional[Path] = None):
+        self.proc = subprocess.Popen(
+            ['git', 'cat-file', '--batch'],
+            cwd=cwd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE
+        )
+
+    def read(self, object_id: str) -> Optional[bytes]:
+        """Return the contents of an object, or None if it doesn't exist."""
+        self.proc.stdin.write(object_id.encode() + b'\n')
+        self.proc.stdin.flush()
+        # Header is "<sha> <type> <size>", or "<object id> missing"
+        header = self.proc.stdout.readline().split()
+        if len(header) != 3:
+            return None
+        data = self.proc.stdout.read(int(header[2]))
+        self.proc.stdout.read(1)  # Trailing newline
+        return data
+
+    def close(self) -> None:
+        self.proc.stdin.close()
+        self.proc.wait()
+        self.proc.stdout.close()
+
+
+class BlobReader:
+    """
+    Reads blobs through one persistent CatFile process per worker thread, so
+    the cost of starting git is paid once per worker instead of once per file.
+    """
+
+    def __init__(self, cwd: Optional[Path] = None):
+        self.cwd = cwd
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.processes: List[CatFile] = []
+
+    def read(self, object_id: str) -> Optional[bytes]:
+        cat_file = getattr(self.local, 'cat_file', None)
+        if cat_file is None:
+            cat_file = self.local.cat_file = CatFile(self.cwd)
+            with self.lock:
+                self.processes.append(cat_file)
+        return cat_file.read(object_id)
+
+    def close(self) -> None:
+        with self.lock:
+            for cat_file in self.processes:
+                cat_file.close()
+            self.processes = []
+
+
+class FileClassifier:
+    """
+    Decides which files are worth blaming at all. Files are skipped if they
+    match an --exclude glob, are larger than max_size bytes, are marked
+    binary, linguist-generated or -diff in .gitattributes, or contain a NUL
+    byte near the start. Skipped files are counted by reason.
+    """
+
+    ATTRIBUTES = ['binary', 'linguist-generated', 'diff']
+
+    def __init__(
+        self,
+        reader: BlobReader,
+        excludes: List[str],
+        max_size: Optional[int],
+        cwd: Optional[Path] = None
+    ):
+        self.reader = reader
+        self.excludes = excludes
+        self.max_size = max_size
+        self.cwd = cwd
+        self.skipped: Counter = Counter()
+        self.lock = threading.Lock()
+
+    def _skip(self, reason: str) -> None:
+        with self.lock:
+            self.skipped[reason] += 1
 
-        commit_hash = parts[0]
+    def _excluded(self, path: str) -> bool:
+        name = os.path.basename(path)
+        return any(fnmatch.fnmatch(path, glob) or fnmatch.fnmatch(name, glob) for glob in self.excludes)
 
-        # Parse metadata
-        author = None
-        line_content = None
+    def filter(self, entries: List[TreeEntry]) -> List[TreeEntry]:
+        """Drop the files that can be ruled out without reading them."""
+        kept = []
+        for entry in entries:
+            if self.excludes and self._excluded(entry.path):
+                self._skip('excluded')
+            elif self.max_size and entry.size is not None and entry.size > self.max_size:
+                self._skip('too large')
+            else:
+                kept.append(entry)
+
+        if not kept:
+            return kept
+
+        # Look up the attributes of all files with one git check-attr call
+        result = subprocess.run(
+            ['git', 'check-attr', '-z', '--stdin'] + self.ATTRIBUTES,
+            cwd=self.cwd,
+            input=b''.join(os.fsencode(entry.path) + b'\0' for entry in kept),
+            capture_output=True
+        )
+        if result.returncode != 0:
+            return kept
+        # Output is "<path>\0<attribute>\0<value>\0" for every path and attribute
+        fields = result.stdout.split(b'\0')
+        ignored = set()
+        for i in range(0, len(fields) - 2, 3):
+            path, attribute, value = fields[i:i + 3]
+            if (attribute == b'binary' and value == b'set') or \
+                    (attribute == b'linguist-generated' and value in (b'set', b'true')) or \
+                    (attribute == b'diff' and value == b'unset'):
+                ignored.add(os.fsdecode(path))
+
+        result = []
+        for entry in kept:
+            if entry.path in ignored:
+                self._skip('marked in .gitattributes')
+            else:
+                result.append(entry)
+        return result
+
+    def is_binary(self, entry: TreeEntry) -> bool:
+        """Sniff the blob for NUL bytes. Call this only for files that are about to be blamed."""
+        if entry.blob is None:
+            return False
+        data = self.reader.read(entry.blob)
+        if data is not None and b'\0' in data[:BINARY_SNIFF_BYTES]:
+            self._skip('binary')
+            return True
+        return False
+
+    def summary(self) -> Optional[str]:
+        """Describe the skipped files, or return None if nothing was skipped."""
+        total = sum(self.skipped.values())
+        if not total:
+            return None
+        reasons = ', '.join(f"{count} {reason}" for reason, count in sorted(self.skipped.items()))
+        return f"Skipped {total} file(s): {reasons}"
+
+
+def iter_blame_file(
+    filepath: str,
+    cwd: Optional[Path] = None,
+    line_ranges: Optional[List[Tuple[int, int]]] = None,
+    commits: Optional[CommitTable] = None,
+    rev: Optional[str] = None,
+    stats: Optional[Stats] = None
+) -> Iterator[Tuple[str, str, int, str]]:
+    """
+    Run git blame on a file and yield blame information line by line as git
+    produces it, so only one blame entry is held in memory at a time.
+    If line_ranges is given, only those (start, end) ranges are blamed.
+    If rev is given, the file is blamed as it was at that revision instead
+    of in the working tree.
+    Commit metadata is recorded in commits, which can be shared between files.
+    The amount of output parsed is counted in stats if given.
+    Yields tuples: (commit_hash, author, line_number, line_content)
+    """
+    if commits is None:
+        commits = CommitTable()
+
+    # Plain porcelain only prints the metadata of each commit the first time
+    # it appears, unlike --line-porcelain which repeats it on every line.
+    args = ['git', 'blame', '--porcelain']
+    if line_ranges:
+        for start, end in line_ranges:
+            args += ['-L', f'{start},{end}']
+    if rev:
+        args.append(rev)
+    args += ['--', filepath]
+
+    proc = subprocess.Popen(
+        args,
+        cwd=cwd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        errors='replace'
+    )
+    parsed = 0
+    try:
+        commit_hash = None
+        info = None
         line_num = None
+        headers: Dict[str, str] = {}
 
-        i += 1
-        while i < len(lines):
-            line = lines[i]
+        for line in proc.stdout:
+            parsed += len(line)
+            line = line.rstrip('\n')
 
-            if line.startswith('author '):
-                author = line[7:]
-            elif line.startswith('author-mail '):
-                author_email = line[12:]
+            if commit_hash is None:
+                # First line: commit hash, original line, final line[, num lines]
+                parts = line.split()
+                if not parts:
+                    continue
+                commit_hash = parts[0]
+                line_num = int(parts[2]) if len(parts) >= 3 else None
+                info = commits.get(commit_hash)
+                headers.clear()
             elif line.startswith('\t'):
-                # This is the actual line content
-                line_content = line[1:]  # Remove the tab
-                # Line number is from the first line parts
-                if len(parts) >= 3:
-                    line_num = int(parts[2])
-                i += 1
-                break
+                # This is the actual line content. It ends the entry.
+                if info is None and 'author' in headers:
+                    info = commits.add(
+                        commit_hash,
+                        headers['author'],
+                        headers.get('author-mail', ''),
+                        int(headers.get('author-time', 0))
+                    )
+                if info is not None and line_num is not None:
+                    yield (commit_hash, info.author, line_num, line[1:])
+                commit_hash = None
+            elif info is None:
+                # Metadata of a commit we haven't seen yet during this run
+                key, _, value = line.partition(' ')
+                headers[key] = value
+
+        stderr = proc.stderr.read()
+        if proc.wait() != 0:
+            print(f"Error running git command: {stderr}", file=sys.stderr)
+    finally:
+        # Stop git if the consumer gave up early
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+        proc.stderr.close()
+        if stats is not None:
+            stats.count('blame bytes', parsed)
+
+
+def git_blame_file(
+    filepath: str,
+    cwd: Optional[Path] = None,
+    line_ranges: Optional[List[Tuple[int, int]]] = None,
+    commits: Optional[CommitTable] = None,
+    rev: Optional[str] = None
+) -> List[Tuple[str, str, int, str]]:
+    """
+    Run git blame on a file and return blame information.
+    If line_ranges is given, only those (start, end) ranges are blamed.
+    Returns list of tuples: (commit_hash, author, line_number, line_content)
+    """
+    return list(iter_blame_file(filepath, cwd, line_ranges, commits, rev))
+
+
+class BlameCache:
+    """
+    On-disk cache of parsed blame rows, stored in SQLite under .git/blamegrep-cache.
+
+    Entries are keyed by (commit, path, blob SHA at that commit), where the
+    commit is HEAD or the revision being searched. An entry can
+    hold the whole file or just the line ranges that have been blamed so far.
+    Partial entries remember the file's line count once a range has run past
+    the end, so that later ranges ending past it can still be answered.
+    Least recently used entries are evicted when the cache grows over max_bytes.
+    Rows refer to commits by SHA; their author metadata is stored once in a
+    separate table and loaded into the run's CommitTable.
+    """
+
+    SCHEMA_VERSION = 3
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            id INTEGER PRIMARY KEY,
+            head TEXT NOT NULL,
+            path TEXT NOT NULL,
+            blob TEXT NOT NULL,
+            complete INTEGER NOT NULL DEFAULT 0,
+            line_count INTEGER,
+            size INTEGER NOT NULL DEFAULT 0,
+            last_used REAL NOT NULL,
+            UNIQUE (head, path, blob)
+        );
+        CREATE TABLE IF NOT EXISTS lines (
+            entry_id INTEGER NOT NULL,
+            line_no INTEGER NOT NULL,
+            commit_hash TEXT NOT NULL,
+            content TEXT NOT NULL,
+            PRIMARY KEY (entry_id, line_no)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS commits (
+            commit_hash TEXT PRIMARY KEY,
+            author TEXT NOT NULL,
+            author_mail TEXT NOT NULL,
+            author_time INTEGER NOT NULL
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+    """
+
+    # Rough per-row overhead on top of the stored strings, used for the size bound
+    ROW_OVERHEAD = 64
+
+    def __init__(self, db_path: Path, prefix: str, max_bytes: int, commits: CommitTable):
+        self.head = ''
+        self.prefix = prefix
+        self.blobs: Dict[str, str] = {}
+        self.max_bytes = max_bytes
+        self.commits = commits
+        self.hits = 0
+        self.misses = 0
+        self.uncacheable = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        # This is only a cache, so durability doesn't matter
+        self.conn.execute('PRAGMA synchronous = OFF')
+        (version,) = self.conn.execute('PRAGMA user_version').fetchone()
+        if version != self.SCHEMA_VERSION:
+            # Old cache layout, start from scratch
+            self.conn.executescript('DROP TABLE IF EXISTS lines; DROP TABLE IF EXISTS entries; DROP TABLE IF EXISTS commits;')
+            self.conn.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+        self.conn.executescript(self.SCHEMA)
+
+    @classmethod
+    def open(
+        cls,
+        cwd: Optional[Path] = None,
+        max_bytes: int = DEFAULT_CACHE_SIZE_MB * 1024 * 1024,
+        commits: Optional[CommitTable] = None
+    ) -> Optional['BlameCache']:
+        """
+        Open the cache for the repository at cwd. Call load_tree() before
+        looking anything up. Returns None if cwd isn't in a repository.
+        """
+        result = subprocess.run(
+            ['git', 'rev-parse', '--git-common-dir', '--show-prefix'],
+            cwd=cwd, capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            return None
+        git_dir, prefix = result.stdout.split('\n')[:2]
+
+        cache_dir = (Path(cwd or '.') / git_dir) / CACHE_DIR_NAME
+        cache_dir.mkdir(exist_ok=True)
+        return cls(cache_dir / 'blame.sqlite', prefix, max_bytes, commits if commits is not None else CommitTable())
+
+    def load_tree(self, entries: List[TreeEntry], cwd: Optional[Path] = None, rev: Optional[str] = None) -> bool:
+        """
+        Key the following lookups on rev, or on HEAD and the working tree if
+        rev is None, using the blob SHAs of the listed files.
+        Returns False if the revision can't be read.
+        """
+        result = subprocess.run(
+            ['git', 'rev-parse', '--verify', f'{rev or "HEAD"}^{{commit}}'],
+            cwd=cwd, capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            return False
+        head = result.stdout.strip()
+
+        # Blob SHAs by path relative to the repository root
+        blobs = {
+            os.path.normpath(self.prefix + entry.path): entry.blob
+            for entry in entries if entry.blob is not None
+        }
+
+        if rev is None:
+            # Files with local changes don't match their blob at HEAD, so leave them out
+            result = subprocess.run(
+                ['git', 'diff', '--name-only', '-z', 'HEAD'],
+                cwd=cwd, capture_output=True
+            )
+            if result.returncode != 0:
+                return False
+            for path in result.stdout.split(b'\0'):
+                blobs.pop(os.fsdecode(path), None)
+
+        self.head = head
+        self.blobs = blobs
+        return True
+
+    def _key(self, filepath: str) -> Optional[Tuple[str, str]]:
+        path = os.path.normpath(self.prefix + filepath)
+        blob = self.blobs.get(path)
+        if blob is None:
+            return None
+        return path, blob
+
+    def get(
+        self,
+        filepath: str,
+        line_ranges: Optional[List[Tuple[int, int]]]
+    ) -> Optional[Iterator[Tuple[str, str, int, str]]]:
+        """
+        Return cached blame rows for filepath, or None if they aren't all cached.
+        The rows are read in batches of CACHE_BATCH_SIZE as they're consumed,
+        so a big file is never held in memory or holds the lock for long.
+        """
+        key = self._key(filepath)
+        if key is None:
+            with self.lock:
+                self.uncacheable += 1
+            return None
+
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT id, complete, line_count FROM entries WHERE head = ? AND path = ? AND blob = ?',
+                (self.head,) + key
+            ).fetchone()
+            if row is None or (line_ranges is None and not row[1]):
+                self.misses += 1
+                return None
+            entry_id, complete, line_count = row
+
+            ranges: List[Tuple[int, int]] = []
+            for start, end in line_ranges or [(1, sys.maxsize)]:
+                if line_count is not None:
+                    # Context can reach past the end of the file
+                    end = min(end, line_count)
+                if not complete:
+                    # A partial entry must contain every requested line
+                    (count,) = self.conn.execute(
+                        'SELECT COUNT(*) FROM lines WHERE entry_id = ? AND line_no BETWEEN ? AND ?',
+                        (entry_id, start, end)
+                    ).fetchone()
+                    if count != max(end - start + 1, 0):
+                        self.misses += 1
+                        return None
+                ranges.append((start, end))
+
+            self.conn.execute('UPDATE entries SET last_used = ? WHERE id = ?', (time.time(), entry_id))
+            self.hits += 1
+        return self._iter_rows(entry_id, ranges)
+
+    def _iter_rows(self, entry_id: int, ranges: List[Tuple[int, int]]) -> Iterator[Tuple[str, str, int, str]]:
+        for start, end in ranges:
+            while start <= end:
+                # Each batch is a query of its own, so the lock is only held while reading it
+                with self.lock:
+                    rows = self.conn.execute(
+                        'SELECT commit_hash, line_no, content FROM lines '
+                        'WHERE entry_id = ? AND line_no BETWEEN ? AND ? ORDER BY line_no LIMIT ?',
+                        (entry_id, start, end, CACHE_BATCH_SIZE)
+                    ).fetchall()
+                    batch = [
+                        (commit_hash, self._load_commit(commit_hash).author, line_num, content)
+                        for commit_hash, line_num, content in rows
+                    ]
+                yield from batch
+                if len(rows) < CACHE_BATCH_SIZE:
+                    break
+                start = rows[-1][1] + 1
+
+    def _load_commit(self, commit_hash: str) -> CommitInfo:
+        info = self.commits.get(commit_hash)
+        if info is None:
+            author, author_mail, author_time = self.conn.execute(
+                'SELECT author, author_mail, author_time FROM commits WHERE commit_hash = ?',
+                (commit_hash,)
+            ).fetchone()
+            info = self.commits.add(commit_hash, author, author_mail, author_time)
+        return info
+
+    def put(
+        self,
+        filepath: str,
+        rows: List[Tuple[str, str, int, str]],
+        complete: bool = False,
+        line_count: Optional[int] = None
+    ) -> None:
+        """
+        Store blame rows for filepath. Rows can be added in several batches;
+        pass complete=True once the whole file has been stored, and
+        line_count once it's known.
+        """
+        key = self._key(filepath)
+        if key is None or not (rows or complete or line_count is not None):
+            return
+
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR IGNORE INTO entries (head, path, blob, last_used) VALUES (?, ?, ?, ?)',
+                (self.head,) + key + (time.time(),)
+            )
+            (entry_id,) = self.conn.execute(
+                'SELECT id FROM entries WHERE head = ? AND path = ? AND blob = ?',
+                (self.head,) + key
+            ).fetchone()
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO lines (entry_id, line_no, commit_hash, content) '
+                'VALUES (?, ?, ?, ?)',
+                [(entry_id, line_num, commit_hash, content)
+                 for commit_hash, _, line_num, content in rows]
+            )
+            new_commits = {commit_hash for commit_hash, _, _, _ in rows}
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO commits (commit_hash, author, author_mail, author_time) '
+                'VALUES (?, ?, ?, ?)',
+                [(commit_hash,) + tuple(self.commits.get(commit_hash)) for commit_hash in new_commits]
+            )
+            self.conn.execute(
+                'UPDATE entries SET complete = complete OR ?, line_count = COALESCE(?, line_count), size = '
+                '(SELECT COALESCE(SUM(length(commit_hash) + length(content) + ?), 0) '
+                ' FROM lines WHERE entry_id = ?) '
+                'WHERE id = ?',
+                (complete, line_count, self.ROW_OVERHEAD, entry_id, entry_id)
+            )
+
+    def total_size(self) -> Tuple[int, int]:
+        """Return (number of entries, approximate size in bytes)."""
+        with self.lock:
+            count, size = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return count, size
+
+    def evict(self) -> int:
+        """Drop least recently used entries until the cache fits in max_bytes. Returns the number dropped."""
+        _, size = self.total_size()
+        with self.lock:
+            cursor = self.conn.execute('SELECT id, size FROM entries ORDER BY last_used')
+            victims = []
+            for entry_id, entry_size in cursor:
+                if size <= self.max_bytes:
+                    break
+                victims.append((entry_id,))
+                size -= entry_size
+            self.conn.executemany('DELETE FROM lines WHERE entry_id = ?', victims)
+            self.conn.executemany('DELETE FROM entries WHERE id = ?', victims)
+            if victims:
+                self.conn.execute(
+                    'DELETE FROM commits WHERE commit_hash NOT IN (SELECT commit_hash FROM lines)'
+                )
+        return len(victims)
+
+    def stats(self) -> str:
+        """Summarize cache usage for --cache-stats."""
+        entries, size = self.total_size()
+        return (
+            f"Blame cache: {self.hits} hits, {self.misses} misses, "
+            f"{self.uncacheable} uncacheable; {entries} entries, "
+            f"{size / (1024 * 1024):.1f} MB (limit {self.max_bytes / (1024 * 1024):.0f} MB)"
+        )
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+
+class LineIndex:
+    """
+    Persistent line-ownership index, stored in SQLite under .git/blamegrep-index.
+
+    For one indexed commit it keeps, for every text file, a compact array of
+    commit ids with one entry per line, plus a table of those commits. It's
+    built with blame once and then kept up to date by replaying the diffs
+    of new commits. Queries read owners from it instead of running blame for
+    files that haven't changed since the indexed commit.
+    """
+
+    SCHEMA_VERSION = 1
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS commits (
+            id INTEGER PRIMARY KEY,
+            commit_hash TEXT NOT NULL UNIQUE,
+            author TEXT NOT NULL,
+            author_mail TEXT NOT NULL,
+            author_time INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            owners BLOB NOT NULL
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, db_path: Path, toplevel: Path, prefix: str):
+        self.toplevel = toplevel
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        (version,) = self.conn.execute('PRAGMA user_version').fetchone()
+        if version != self.SCHEMA_VERSION:
+            self.conn.executescript('DROP TABLE IF EXISTS meta; DROP TABLE IF EXISTS commits; DROP TABLE IF EXISTS files;')
+            self.conn.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+        self.conn.executescript(self.SCHEMA)
+
+        self.commit_ids: Dict[str, int] = dict(self.conn.execute('SELECT commit_hash, id FROM commits'))
+        self.commit_hashes: Dict[int, str] = {i: h for h, i in self.commit_ids.items()}
+        # Set up by prepare_queries()
+        self.changed: Set[str] = set()
+        self.commits: Optional[CommitTable] = None
+
+    @classmethod
+    def open(cls, cwd: Optional[Path] = None, create: bool = False) -> Optional['LineIndex']:
+        """Open the index of the repository at cwd. Returns None if there is none and create is False."""
+        result = subprocess.run(
+            ['git', 'rev-parse', '--git-common-dir', '--show-toplevel', '--show-prefix'],
+            cwd=cwd, capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            return None
+        git_dir, toplevel, prefix = result.stdout.split('\n')[:3]
+
+        index_dir = (Path(cwd or '.') / git_dir) / INDEX_DIR_NAME
+        db_path = index_dir / 'index.sqlite'
+        if not create and not db_path.exists():
+            return None
+        index_dir.mkdir(exist_ok=True)
+        return cls(db_path, Path(toplevel), prefix)
+
+    @property
+    def commit(self) -> Optional[str]:
+        """The commit the index describes, or None if it hasn't been built."""
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'commit'").fetchone()
+        return row[0] if row else None
+
+    def prepare_queries(self, commits: CommitTable) -> bool:
+        """
+        Get ready to answer lookups for the working tree: load the commits
+        into the run's commit table and find the files that have changed
+        since the indexed commit. Returns False if the index can't be used.
+        """
+        commit = self.commit
+        if commit is None:
+            return False
+        result = subprocess.run(
+            ['git', 'diff', '--name-only', '-z', commit],
+            cwd=self.toplevel, capture_output=True
+        )
+        if result.returncode != 0:
+            return False
+        self.changed = {os.fsdecode(path) for path in result.stdout.split(b'\0') if path}
+
+        for commit_hash, author, author_mail, author_time in self.conn.execute(
+            'SELECT commit_hash, author, author_mail, author_time FROM commits'
+        ):
+            commits.add(commit_hash, author, author_mail, author_time)
+        self.commits = commits
+        return True
+
+    def owners(self, filepath: str) -> Optional[array]:
+        """
+        Return the commit id of every line of filepath, or None if the file
+        isn't indexed or has changed since the indexed commit.
+        """
+        path = os.path.normpath(self.prefix + filepath)
+        if path in self.changed:
+            return None
+        with self.lock:
+            return self.load(path)
+
+    def iter_rows(
+        self,
+        filepath: str,
+        owners: array,
+        cwd: Optional[Path],
+        line_ranges: Optional[List[Tuple[int, int]]]
+    ) -> Iterator[Tuple[str, str, int, str]]:
+        """
+        Yield blame rows for the working tree copy of filepath, taking the
+        line owners from the index instead of running blame.
+        """
+        ranges = iter(line_ranges or [(1, len(owners))])
+        start, end = next(ranges, (0, 0))
+        # Read the file like the blame output is read, with universal newlines
+        with open(Path(cwd or '.') / filepath, encoding='utf-8', errors='replace') as f:
+            for line_num, line in enumerate(f, 1):
+                while line_num > end:
+                    start, end = next(ranges, (0, 0))
+                    if end == 0:
+                        return
+                if line_num < start or line_num > len(owners):
+                    continue
+                commit_hash = self.commit_hashes[owners[line_num - 1]]
+                yield (commit_hash, self.commits.get(commit_hash).author, line_num, line.rstrip('\n'))
+
+    # Building and updating
+
+    def commit_id(self, commit_hash: str, info: CommitInfo) -> int:
+        """Return the id of a commit, adding it to the commit table if needed."""
+        commit_id = self.commit_ids.get(commit_hash)
+        if commit_id is None:
+            cursor = self.conn.execute(
+                'INSERT INTO commits (commit_hash, author, author_mail, author_time) VALUES (?, ?, ?, ?)',
+                (commit_hash,) + tuple(info)
+            )
+            commit_id = self.commit_ids[commit_hash] = cursor.lastrowid
+            self.commit_hashes[commit_id] = commit_hash
+        return commit_id
+
+    def load(self, path: str) -> Optional[array]:
+        """Return the stored owners of path (relative to the repository root)."""
+        row = self.conn.execute('SELECT owners FROM files WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            return None
+        owners = array('I')
+        owners.frombytes(row[0])
+        return owners
+
+    def store(self, path: str, owners: array) -> None:
+        self.conn.execute('INSERT OR REPLACE INTO files (path, owners) VALUES (?, ?)', (path, owners.tobytes()))
+
+    def remove(self, path: str) -> None:
+        self.conn.execute('DELETE FROM files WHERE path = ?', (path,))
+
+    def clear(self) -> None:
+        self.conn.execute('DELETE FROM files')
+
+    def set_commit(self, commit_hash: str) -> None:
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('commit', ?)", (commit_hash,))
+
+    def save(self) -> None:
+        self.conn.commit()
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+
+def blame_into_index(
+    index: LineIndex,
+    entries: List[TreeEntry],
+    commit: str,
+    classifier: Optional[FileClassifier],
+    jobs: int
+) -> int:
+    """Blame entries (paths relative to the repository root) at commit and store their owners. Returns the count."""
+    if classifier is not None:
+        entries = [e for e in classifier.filter(entries) if not classifier.is_binary(e)]
+
+    commits = CommitTable()
+
+    def blame(entry: TreeEntry) -> List[str]:
+        return [row[0] for row in iter_blame_file(entry.path, index.toplevel, None, commits, commit)]
+
+    for entry, line_commits in zip(entries, map_ordered(blame, entries, jobs)):
+        owners = array('I', (index.commit_id(h, commits.get(h)) for h in line_commits))
+        index.store(entry.path, owners)
+    return len(entries)
+
+
+def apply_hunks(owners: array, hunks: List[Tuple[int, int, int, int]], commit_id: int) -> array:
+    """
+    Apply the hunks of a diff (old_start, old_count, new_start, new_count) to
+    the line owners of the old file. The new lines are owned by commit_id.
+    """
+    result = array('I')
+    pos = 0
+    for old_start, old_count, _, new_count in hunks:
+        # With old_count == 0 the lines are inserted after old_start
+        start = old_start if old_count == 0 else old_start - 1
+        result.extend(owners[pos:start])
+        result.extend(array('I', [commit_id]) * new_count)
+        pos = start + old_count
+    result.extend(owners[pos:])
+    return result
+
 
-            i += 1
+def unquote_path(path: str) -> str:
+    """Undo git's C-style quoting of unusual path names."""
+    if not path.startswith('"'):
+        return path
+    return os.fsdecode(codecs.escape_decode(os.fsencode(path[1:-1]))[0])
 
-        if author and line_content is not None and line_num is not None:
-            results.append((commit_hash, author, line_num, line_content))
 
-    return results
+def iter_first_parent_diffs(
+    old: str,
+    new: str,
+    cwd: Path
+) -> Iterator[Tuple[str, bool, CommitInfo, str, str, List[Tuple[int, int, int, int]]]]:
+    """
+    Yield the file changes of every first-parent commit in old..new, oldest
+    first, parsed from a single git log -p -U0 run. Yields tuples:
+    (commit_hash, is_merge, commit_info, old_path, new_path, hunks) where a
+    missing side is None and hunks is None for binary changes.
+    """
+    proc = subprocess.Popen(
+        ['git', '-c', 'core.quotePath=false', 'log', '--reverse', '--first-parent',
+         '--diff-merges=first-parent', '-p', '-U0', '--no-renames', '--no-color', '--no-ext-diff',
+         '--format=%x00commit %H %P%x00%aN%x00<%aE>%x00%at', f'{old}..{new}'],
+        cwd=cwd, stdout=subprocess.PIPE, text=True, errors='surrogateescape'
+    )
+    commit_hash = ''
+    is_merge = False
+    info = CommitInfo('', '', 0)
+    old_path = new_path = None
+    hunks: Optional[List[Tuple[int, int, int, int]]] = None
+    in_file = False
+    old_left = new_left = 0
+
+    def finish():
+        return (commit_hash, is_merge, info, old_path, new_path, hunks)
+
+    for line in proc.stdout:
+        line = line.rstrip('\n')
+
+        # Lines inside a hunk are content, whatever they look like
+        if old_left or new_left:
+            if line.startswith('-'):
+                old_left -= 1
+            elif line.startswith('+'):
+                new_left -= 1
+            continue
+
+        if line.startswith('\0commit '):
+            if in_file:
+                yield finish()
+                in_file = False
+            header, author, mail, author_time = line[1:].split('\0')
+            commit_hash, *parents = header.split()[1:]
+            is_merge = len(parents) > 1
+            info = CommitInfo(author, mail, int(author_time))
+        elif line.startswith('diff --git '):
+            if in_file:
+                yield finish()
+            in_file = True
+            # Without renames this is "a/<path> b/<path>" with the same path
+            # twice, each side quoted if needed
+            names = line[len('diff --git '):]
+            old_path = new_path = unquote_path(names[:(len(names) - 1) // 2])[2:]
+            hunks = []
+        elif line.startswith('new file mode '):
+            old_path = None
+        elif line.startswith('deleted file mode '):
+            new_path = None
+        elif line.startswith('--- ') or line.startswith('+++ '):
+            # Names with spaces get a trailing tab
+            name = line[4:].rstrip('\t')
+            path = None if name == '/dev/null' else unquote_path(name)[2:]
+            if line.startswith('-'):
+                old_path = path
+            else:
+                new_path = path
+        elif line.startswith('Binary files '):
+            hunks = None
+        elif line.startswith('@@ ') and hunks is not None:
+            # "@@ -old_start[,old_count] +new_start[,new_count] @@"
+            old_range, new_range = line.split()[1:3]
+            old_start, _, old_count = old_range[1:].partition(',')
+            new_start, _, new_count = new_range[1:].partition(',')
+            hunk = (int(old_start), int(old_count or 1), int(new_start), int(new_count or 1))
+            hunks.append(hunk)
+            old_left, new_left = hunk[1], hunk[3]
+    if in_file:
+        yield finish()
+    proc.wait()
+
+
+def update_index(index: LineIndex, head: str, classifier: Optional[FileClassifier], jobs: int) -> Tuple[int, int]:
+    """
+    Bring the index from its commit to head by replaying the diffs of the
+    commits in between. Files that diffs can't describe well (new files,
+    binary changes and changes brought in by merges) are blamed again.
+    Returns (number of files updated from diffs, number of files blamed).
+    """
+    old = index.commit
+    working: Dict[str, Optional[array]] = {}
+    reblame: Set[str] = set()
+
+    for commit_hash, is_merge, info, old_path, new_path, hunks in iter_first_parent_diffs(old, head, index.toplevel):
+        if new_path is None:
+            # Deleted
+            working[old_path] = None
+            reblame.discard(old_path)
+            continue
+        if old_path is None or hunks is None or is_merge or new_path in reblame:
+            reblame.add(new_path)
+            continue
+
+        owners = working[new_path] if new_path in working else index.load(new_path)
+        if owners is None:
+            # Not indexed, e.g. it used to be binary
+            reblame.add(new_path)
+            continue
+        working[new_path] = apply_hunks(owners, hunks, index.commit_id(commit_hash, info))
+
+    for path, owners in working.items():
+        if path in reblame:
+            continue
+        if owners is None:
+            index.remove(path)
+        else:
+            index.store(path, owners)
+
+    entries = [e for e in list_tree_files(head, [], index.toplevel) if e.path in reblame]
+    for path in reblame:
+        index.remove(path)
+    blamed = blame_into_index(index, entries, head, classifier, jobs)
+    index.set_commit(head)
+    index.save()
+    return len(working) - len(reblame & working.keys()), blamed
+
+
+def iter_cached_blame(
+    filepath: str,
+    cwd: Optional[Path],
+    line_ranges: Optional[List[Tuple[int, int]]],
+    cache: Optional[BlameCache],
+    commits: Optional[CommitTable] = None,
+    rev: Optional[str] = None,
+    index: Optional[LineIndex] = None,
+    stats: Optional[Stats] = None
+) -> Iterator[Tuple[str, str, int, str]]:
+    """
+    Blame a file, going through the line index or the cache if there is
+    one. The cache must have been loaded for the same rev; the index is
+    only for the working tree. Where the rows came from is counted in stats.
+    """
+    if index is not None:
+        owners = index.owners(filepath)
+        if owners is not None:
+            if stats is not None:
+                stats.count('index')
+            yield from index.iter_rows(filepath, owners, cwd, line_ranges)
+            return
+
+    if cache is None:
+        if stats is not None:
+            stats.count('blamed')
+        yield from iter_blame_file(filepath, cwd, line_ranges, commits, rev, stats)
+        return
+
+    cached = cache.get(filepath, line_ranges)
+    if cached is not None:
+        if stats is not None:
+            stats.count('cache')
+        yield from cached
+        return
+
+    if stats is not None:
+        stats.count('blamed')
+
+    # Write rows to the cache in batches so a big file is never held in memory
+    batch = []
+    last_line = 0
+    for row in iter_blame_file(filepath, cwd, line_ranges, cache.commits, rev, stats):
+        batch.append(row)
+        last_line = max(last_line, row[2])
+        if len(batch) >= CACHE_BATCH_SIZE:
+            cache.put(filepath, batch)
+            batch = []
+        yield row
+    if last_line:
+        # git blame stops the last range at the end of the file
+        line_count = last_line if line_ranges and line_ranges[-1][1] > last_line else None
+        cache.put(filepath, batch, complete=line_ranges is None, line_count=line_count)
+
+
+def iter_search_file(
+    filepath: str,
+    pattern: re.Pattern,
+    author_pattern: Optional[re.Pattern],
+    case_insensitive: bool,
+    cwd: Optional[Path] = None,
+    line_ranges: Optional[List[Tuple[int, int]]] = None,
+    cache: Optional[BlameCache] = None,
+    commits: Optional[CommitTable] = None
+) -> Iterator[Tuple[str, int, str, str]]:
+    """
+    Search for pattern in file and filter by author, yielding matches as
+    soon as git blame reports them.
+    Yields tuples: (filepath, line_number, author, line_content)
+    """
+    for commit_hash, author, line_num, line_content in iter_cached_blame(filepath, cwd, line_ranges, cache, commits):
+        # Check if line matches the search pattern
+        if pattern.search(line_content):
+            # Check if author matches (if author filter is specified)
+            if author_pattern is None or author_pattern.search(author):
+                yield (filepath, line_num, author, line_content)
+
+
+class PatternSet:
+    """
+    Several search patterns matched in one pass over each line. A combined
+    alternation rules out most lines with a single regex search; only lines
+    that pass it are checked against each pattern to tag the hit.
+    """
+
+    # Backreferences would point at the wrong group inside the alternation
+    BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+
+    def __init__(self, sources: List[str], flags: int = 0):
+        # Raises re.error for an invalid pattern
+        self.patterns = [(source, re.compile(source, flags)) for source in sources]
+        self.combined: Optional[re.Pattern] = None
+        if len(sources) > 1 and not any(self.BACKREFERENCE.search(s) for s in sources):
+            try:
+                self.combined = re.compile('|'.join(f'(?:{s})' for s in sources), flags)
+            except re.error:
+                # e.g. inline global flags that are only valid at the start
+                pass
+
+    def __len__(self) -> int:
+        return len(self.patterns)
+
+    def match(self, line: str) -> Tuple[str, ...]:
+        """
+        Returns the patterns that match line, in the order they were given,
+        or an empty tuple if none match.
+        """
+        if self.combined is not None and not self.combined.search(line):
+            return ()
+        return tuple(source for source, pattern in self.patterns if pattern.search(line))
+
+
+def with_context(
+    rows: Iterable[Tuple[str, str, int, str]],
+    is_match: Callable[[Tuple[str, str, int, str]], Tuple[str, ...]],
+    context: int
+) -> Iterator[Tuple[Tuple[str, ...], Tuple[str, str, int, str]]]:
+    """
+    Pick the matching blame rows and the rows within context lines of them.
+    is_match returns the tags of a matching row and an empty tuple otherwise.
+    Yields (tags, row) in line order, with empty tags for context rows.
+    Overlapping windows are merged as rows go by, so each row is yielded at
+    most once.
+    """
+    before: deque = deque()
+    after_until = 0
+
+    for row in rows:
+        line_num = row[2]
+        tags = is_match(row)
+        if tags:
+            while before:
+                earlier = before.popleft()
+                if earlier[2] >= line_num - context:
+                    yield (), earlier
+            yield tags, row
+            after_until = line_num + context
+        elif line_num <= after_until:
+            yield (), row
+        elif context > 0:
+            before.append(row)
+            # Only keep rows that could be before-context for a later match
+            while before[0][2] <= line_num - context:
+                before.popleft()
+
+
+def iter_search_file_context(
+    filepath: str,
+    patterns: PatternSet,
+    author_pattern: Optional[re.Pattern],
+    context: int,
+    cwd: Optional[Path] = None,
+    line_ranges: Optional[List[Tuple[int, int]]] = None,
+    cache: Optional[BlameCache] = None,
+    commits: Optional[CommitTable] = None,
+    rev: Optional[str] = None,
+    index: Optional[LineIndex] = None,
+    stats: Optional[Stats] = None
+) -> Iterator[Tuple[Tuple[str, ...], Tuple[str, int, str, str, str]]]:
+    """
+    Search for patterns in file and filter by author, also yielding up to
+    context lines around each match from the same blame output.
+    Yields (tags, (filepath, line_number, author, line_content, commit_hash)),
+    where tags are the patterns that matched the line, or empty for a
+    context line.
+    """
+    def is_match(row: Tuple[str, str, int, str]) -> Tuple[str, ...]:
+        _, author, _, line_content = row
+        if author_pattern is not None and not author_pattern.search(author):
+            return ()
+        return patterns.match(line_content)
+
+    rows = iter_cached_blame(filepath, cwd, line_ranges, cache, commits, rev, index, stats)
+    results = with_context(rows if stats is None else stats.timed('blame', rows), is_match, context)
+    if stats is not None:
+        results = stats.timed('search', results, filepath if rev is None else f"{rev[:12]}:{filepath}")
+    for matched, (commit_hash, author, line_num, line_content) in results:
+        yield matched, (filepath, line_num, author, line_content, commit_hash)
 
 
 def search_in_file(
@@ -101,34 +1543,175 @@ def search_in_file(
     pattern: re.Pattern,
     author_pattern: Optional[re.Pattern],
     case_insensitive: bool,
-    cwd: Optional[Path] = None
+    cwd: Optional[Path] = None,
+    line_ranges: Optional[List[Tuple[int, int]]] = None,
+    cache: Optional[BlameCache] = None,
+    commits: Optional[CommitTable] = None
 ) -> List[Tuple[str, int, str, str]]:
     """
     Search for pattern in file and filter by author.
     Returns list of tuples: (filepath, line_number, author, line_content)
     """
-    blame_info = git_blame_file(filepath, cwd)
-    results = []
+    return list(iter_search_file(
+        filepath, pattern, author_pattern, case_insensitive, cwd, line_ranges, cache, commits
+    ))
 
-    for commit_hash, author, line_num, line_content in blame_info:
-        # Check if line matches the search pattern
-        if pattern.search(line_content):
-            # Check if author matches (if author filter is specified)
-            if author_pattern is None or author_pattern.search(author):
-                results.append((filepath, line_num, author, line_content))
 
-    return results
+def map_ordered(
+    func: Callable[[T], R],
+    items: Iterable[T],
+    jobs: int,
+    pool: Optional[ThreadPoolExecutor] = None
+) -> Iterator[R]:
+    """
+    Apply func to each item using a pool of jobs threads.
+    Results are yielded in input order as soon as they and all earlier ones are done.
+    If pool is given, its threads are used and it's left running for the
+    next call, so that per-thread state such as BlobReader's processes is reused.
+    """
+    if jobs <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    if pool is None:
+        with ThreadPoolExecutor(max_workers=jobs) as own_pool:
+            yield from map_ordered(func, items, jobs, own_pool)
+        return
+
+    # The work is dominated by git subprocesses, so threads are enough. Keep a
+    # bounded window of submitted items so that a huge file list doesn't queue
+    # up (and buffer) every result at once.
+    window = jobs * 4
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+class RecordWriter:
+    """
+    Write search results to stdout as NDJSON or CSV records, one per line,
+    as soon as they're found.
+    """
+
+    def __init__(self, output_format: str, with_rev: bool):
+        self.output_format = output_format
+        self.fields = (['rev'] if with_rev else []) + RECORD_FIELDS
+        self.writer = None
+        if output_format == 'csv':
+            self.writer = csv.writer(sys.stdout, lineterminator='\n')
+            self.writer.writerow(self.fields)
+
+    def write(self, record: Dict[str, object]):
+        row = [record[field] for field in self.fields]
+        if self.writer is None:
+            print(json.dumps(dict(zip(self.fields, row)), ensure_ascii=False))
+        else:
+            self.writer.writerow(
+                ', '.join(value) if isinstance(value, list) else
+                str(value).lower() if isinstance(value, bool) else value
+                for value in row
+            )
+
+
+def print_counts(counts: Counter, key: str, output_format: str):
+    """Print the number of matches per key, most common first."""
+    rows = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+    if output_format == 'ndjson':
+        for value, count in rows:
+            print(json.dumps({key: value, 'count': count}, ensure_ascii=False))
+    elif output_format == 'csv':
+        writer = csv.writer(sys.stdout, lineterminator='\n')
+        writer.writerow([key, 'count'])
+        writer.writerows(rows)
+    else:
+        for value, count in rows:
+            print(f"{count:7d} {value}")
+
+
+def index_main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog='git-blamegrep.py index',
+        description='Build a line-ownership index for HEAD so that searches don\'t need to run git blame.'
+    )
+
+    parser.add_argument(
+        '--update',
+        action='store_true',
+        help='Bring an existing index up to date with HEAD by replaying the new commits'
+    )
+
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=0,
+        metavar='N',
+        help='Run N git blame processes in parallel (0 = number of CPUs, default: 0)'
+    )
+
+    parser.add_argument(
+        '--max-size',
+        type=int,
+        default=DEFAULT_MAX_SIZE_KB,
+        metavar='KB',
+        help=f'Skip files larger than KB kilobytes, 0 for no limit (default: {DEFAULT_MAX_SIZE_KB})'
+    )
+
+    args = parser.parse_args(argv)
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+
+    index = LineIndex.open(Path.cwd(), create=True)
+    if index is None:
+        print("Not in a git repository", file=sys.stderr)
+        return 1
+
+    head = run_git_command(['rev-parse', '--verify', 'HEAD^{commit}'], index.toplevel).strip()
+    reader = BlobReader(index.toplevel)
+    classifier = FileClassifier(reader, [], args.max_size * 1024, index.toplevel)
+
+    old = index.commit
+    if args.update and old == head:
+        print(f"Index is already up to date at {head[:12]}")
+    elif args.update and old is not None and subprocess.run(
+        ['git', 'merge-base', '--is-ancestor', old, head], cwd=index.toplevel
+    ).returncode == 0:
+        patched, blamed = update_index(index, head, classifier, jobs)
+        print(f"Updated index from {old[:12]} to {head[:12]}: {patched} file(s) patched, {blamed} blamed")
+    else:
+        if args.update:
+            print("Index is missing or HEAD is not a descendant of the indexed commit, rebuilding", file=sys.stderr)
+        index.clear()
+        blamed = blame_into_index(index, list_tree_files(head, [], index.toplevel), head, classifier, jobs)
+        index.set_commit(head)
+        index.save()
+        print(f"Indexed {blamed} file(s) at {head[:12]}")
+
+    reader.close()
+    if classifier.summary():
+        print(classifier.summary(), file=sys.stderr)
+    index.close()
+    return 0
 
 
 def main():
+    if sys.argv[1:2] == ['index']:
+        return index_main(sys.argv[2:])
+
     parser = argparse.ArgumentParser(
         description='Search for lines in a git repository authored by a specific author.',
-        epilog='Example: git-blamegrep.py "TODO" --author "John Doe"'
+        epilog='Example: git-blamegrep.py "TODO" --author "John Doe". '
+               'Search for several patterns at once with -e TODO -e FIXME. '
+               'Run "git-blamegrep.py index" to build a line-ownership index that makes searches faster.'
     )
 
     parser.add_argument(
         'pattern',
-        help='Regular expression pattern to search for'
+        nargs='?',
+        help='Regular expression pattern to search for (a path if -e or -f is given)'
     )
 
     parser.add_argument(
@@ -137,6 +1720,20 @@ def main():
         help='Files or directories to search (default: all tracked files)'
     )
 
+    parser.add_argument(
+        '-e', '--regexp',
+        action='append',
+        default=[],
+        metavar='PATTERN',
+        help='Search for PATTERN; can be repeated to search for several patterns in one pass'
+    )
+
+    parser.add_argument(
+        '-f', '--file',
+        metavar='FILE',
+        help='Read patterns from FILE, one per line'
+    )
+
     parser.add_argument(
         '-a', '--author',
         help='Filter by author name (supports regex)'
@@ -175,12 +1772,149 @@ def main():
         help='Show NUM lines of context around matches'
     )
 
+    parser.add_argument(
+        '--format',
+        choices=['text', 'ndjson', 'csv'],
+        default='text',
+        help='Output format. ndjson and csv include the commit and author time of each line (default: text)'
+    )
+
+    parser.add_argument(
+        '--count-by',
+        choices=['author', 'file', 'commit', 'pattern'],
+        help='Only print the number of matching lines per author, file, commit or pattern'
+    )
+
+    parser.add_argument(
+        '--rev',
+        metavar='COMMIT',
+        help='Search the tree at COMMIT instead of the working tree'
+    )
+
+    parser.add_argument(
+        '--revs',
+        metavar='RANGE',
+        help='Search every revision in RANGE (e.g. v1.0..main), prefixing matches with the revision'
+    )
+
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        metavar='N',
+        help='Run N git blame processes in parallel (0 = number of CPUs, default: 1)'
+    )
+
+    parser.add_argument(
+        '--no-prefilter',
+        action='store_true',
+        help="Blame every file instead of only the lines found by git grep"
+    )
+
+    parser.add_argument(
+        '--no-author-first',
+        action='store_true',
+        help="With --author, blame every file instead of only the files the author has changed"
+    )
+
+    parser.add_argument(
+        '--exclude',
+        action='append',
+        default=[],
+        metavar='GLOB',
+        help='Skip files whose path or name matches GLOB (can be repeated)'
+    )
+
+    parser.add_argument(
+        '--max-size',
+        type=int,
+        default=DEFAULT_MAX_SIZE_KB,
+        metavar='KB',
+        help=f'Skip files larger than KB kilobytes, 0 for no limit (default: {DEFAULT_MAX_SIZE_KB})'
+    )
+
+    parser.add_argument(
+        '--no-skip',
+        action='store_true',
+        help='Blame binary, generated and oversized files too'
+    )
+
+    parser.add_argument(
+        '--no-index',
+        action='store_true',
+        help='Run git blame even if there is a line-ownership index'
+    )
+
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Do not read or write the blame cache in .git/blamegrep-cache'
+    )
+
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        default=DEFAULT_CACHE_SIZE_MB,
+        metavar='MB',
+        help=f'Maximum size of the blame cache (default: {DEFAULT_CACHE_SIZE_MB})'
+    )
+
+    parser.add_argument(
+        '--cache-stats',
+        action='store_true',
+        help='Print blame cache statistics to stderr'
+    )
+
+    parser.add_argument(
+        '--stats',
+        action='store_true',
+        help='Print the time spent in each phase, file counts and the slowest files to stderr'
+    )
+
+    parser.add_argument(
+        '--profile',
+        metavar='FILE',
+        help='Run the search under cProfile and write the profile to FILE'
+    )
+
     args = parser.parse_args()
 
-    # Compile search pattern
+    # Collect search patterns. With -e or -f, the first positional argument
+    # is a path like it is for grep.
+    sources = list(args.regexp)
+    if args.file:
+        try:
+            with open(args.file, encoding='utf-8') as f:
+                sources += [line.rstrip('\r\n') for line in f if line.strip()]
+        except OSError as e:
+            print(f"Can't read patterns: {e}", file=sys.stderr)
+            sys.exit(1)
+    if args.regexp or args.file:
+        if args.pattern is not None:
+            args.paths.insert(0, args.pattern)
+    elif args.pattern is not None:
+        sources = [args.pattern]
+    if not sources:
+        parser.error('no pattern given')
+
+    if args.profile:
+        # Only the main thread is profiled; use -j 1 to see the blame parsing
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(run_search, args, sources)
+        finally:
+            profiler.dump_stats(args.profile)
+    return run_search(args, sources)
+
+
+def run_search(args: argparse.Namespace, sources: List[str]) -> int:
+    """Search with the parsed command line arguments. Returns the exit status."""
+    stats = Stats(detailed=args.stats)
+
+    # Compile search patterns
     flags = re.IGNORECASE if args.ignore_case else 0
     try:
-        pattern = re.compile(args.pattern, flags)
+        patterns = PatternSet(sources, flags)
     except re.error as e:
         print(f"Invalid regex pattern: {e}", file=sys.stderr)
         sys.exit(1)
@@ -195,39 +1929,218 @@ def main():
             print(f"Invalid author regex pattern: {e}", file=sys.stderr)
             sys.exit(1)
 
-    # Get list of files to search
     cwd = Path.cwd()
 
-    if args.paths:
-        files = []
-        for path in args.paths:
-            path_obj = Path(path)
-            if path_obj.is_file():
-                files.append(path)
-            elif path_obj.is_dir():
-                files.extend(get_tracked_files(path, cwd))
-            else:
-                print(f"Warning: {path} not found", file=sys.stderr)
-    else:
-        files = get_tracked_files(cwd=cwd)
+    if args.rev and args.revs:
+        print("--rev and --revs can't be used together", file=sys.stderr)
+        sys.exit(1)
+
+    # None stands for the working tree
+    revisions: List[Optional[str]] = [args.rev]
+    if args.revs:
+        revisions = run_git_command(['rev-list', '--reverse', args.revs], cwd).split()
+
+    # Only blame files that the matching authors have ever touched
+    touched = None
+    if author_pattern is not None and not args.no_author_first:
+        with stats.phase('author plan'):
+            touched = author_touched_files(author_pattern, cwd, revisions[-1] if revisions else None)
+    prefix = repo_prefix(cwd)
+
+    # Rule out files that can never match a text pattern before blaming
+    reader = BlobReader(cwd)
+    classifier = None
+    if not args.no_skip:
+        classifier = FileClassifier(reader, args.exclude, args.max_size * 1024, cwd)
+
+    # Commit metadata is parsed once per run and shared by all files
+    commits = CommitTable()
+    cache = None
+    if not args.no_cache:
+        cache = BlameCache.open(cwd, args.cache_size * 1024 * 1024, commits)
+
+    # The line index answers for the working tree files that haven't changed
+    # since it was built
+    index = None
+    if not args.no_index and revisions == [None]:
+        with stats.phase('index'):
+            index = LineIndex.open(cwd)
+            if index is not None and not index.prepare_queries(commits):
+                index.close()
+                index = None
+
+    # git grep only stands in for blame where it's known to match the same lines
+    prefilter = not args.no_prefilter and all(pcre_agrees(source, args.ignore_case) for source in sources)
+
+    context = max(args.context or 0, 0)
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    # One pool for all revisions, so each worker keeps its cat-file process
+    pool = ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
 
-    # Search each file
     total_matches = 0
-    for filepath in files:
-        matches = search_in_file(filepath, pattern, author_pattern, args.ignore_case, cwd)
+    last_printed = None
+    writer = None
+    if args.format != 'text' and not args.count_by:
+        writer = RecordWriter(args.format, bool(args.revs))
+    # Only the running totals are kept, not the matches
+    counts: Optional[Counter] = Counter() if args.count_by else None
+
+    # When sweeping over revisions, the results for each (file, blob) of the
+    # previous revision. Files that haven't changed aren't searched again.
+    previous: Dict[TreeEntry, List[Tuple[Tuple[str, ...], Tuple[str, int, str, str, str]]]] = {}
+
+    for rev in revisions:
+        # Get list of files to search with their blob SHAs and sizes
+        with stats.phase('list files'):
+            if rev is not None:
+                entries = list_tree_files(rev, args.paths, cwd)
+            else:
+                entries = get_tracked_files(args.paths, cwd)
+        listed = len(entries)
+        stats.count('listed', listed)
+
+        if touched is not None:
+            entries = [e for e in entries if os.path.normpath(prefix + e.path) in touched]
+            stats.count('not touched by author', listed - len(entries))
+
+        if classifier is not None:
+            planned = len(entries)
+            with stats.phase('classify'):
+                entries = classifier.filter(entries)
+            stats.count('skipped', planned - len(entries))
+
+        if cache is not None:
+            with stats.phase('cache'):
+                if not cache.load_tree(entries, cwd, rev):
+                    cache.close()
+                    cache = None
+
+        # Narrow the files and lines down with git grep so that only lines
+        # that can match get blamed. In a sweep, only changed files need it.
+        changed = [e for e in entries if e not in previous]
+        candidates = None
+        if prefilter:
+            with stats.phase('grep'):
+                if previous and len(changed) <= MAX_GREP_PATHS:
+                    grep_paths = [entry.path for entry in changed]
+                    candidates = grep_candidate_lines(
+                        sources, grep_paths, args.ignore_case, cwd, rev, literal_paths=True
+                    ) if grep_paths else {}
+                else:
+                    candidates = grep_candidate_lines(sources, args.paths, args.ignore_case, cwd, rev)
+
+        # Files without candidate lines can't match, remember them as such
+        current: Dict[TreeEntry, List[Tuple[Tuple[str, ...], Tuple[str, int, str, str, str]]]] = {}
+        if candidates is not None:
+            for entry in changed:
+                if os.path.normpath(entry.path) not in candidates:
+                    current[entry] = []
+            entries = [e for e in entries if e not in current]
+            stats.count('no candidates', len(current))
+
+        def search(entry: TreeEntry) -> Iterable[Tuple[Tuple[str, ...], Tuple[str, int, str, str, str]]]:
+            if entry in previous:
+                stats.count('unchanged')
+                return previous[entry]
+            if classifier is not None and classifier.is_binary(entry):
+                stats.count('skipped')
+                return []
+            filepath = entry.path
+            line_ranges = None
+            if candidates is not None:
+                line_ranges = to_line_ranges(candidates[os.path.normpath(filepath)], context)
+                if len(line_ranges) > MAX_BLAME_RANGES:
+                    line_ranges = None
+            return iter_search_file_context(
+                filepath, patterns, author_pattern, context, cwd, line_ranges, cache, commits, rev, index, stats
+            )
+
+        if len(revisions) > 1 or jobs > 1:
+            # Workers collect each file's matches; printing happens in file order
+            per_file = map_ordered(lambda entry: list(search(entry)), entries, jobs, pool)
+        else:
+            # Stream matches straight from git blame to the output
+            per_file = map(search, entries)
+
+        # Search each file, printing results in file order
+        for entry, matches in zip(entries, per_file):
+            if len(revisions) > 1:
+                current[entry] = matches
+
+            for tags, (file, line_num, author, line_content, commit_hash) in matches:
+                if tags:
+                    total_matches += 1
+
+                if counts is not None:
+                    if tags:
+                        if args.count_by == 'pattern':
+                            counts.update(tags)
+                        else:
+                            counts[{'author': author, 'file': file, 'commit': commit_hash}[args.count_by]] += 1
+                    continue
+
+                if writer is not None:
+                    info = commits.get(commit_hash)
+                    writer.write({
+                        'rev': rev,
+                        'file': file,
+                        'line': line_num,
+                        'commit': commit_hash,
+                        'author': author,
+                        'author_mail': info.author_mail.strip('<>') if info else '',
+                        'author_time': info.author_time if info else None,
+                        'match': bool(tags),
+                        'patterns': list(tags),
+                        'content': line_content,
+                    })
+                    continue
+
+                # Separate non-adjacent groups like grep does
+                if args.context is not None and last_printed is not None and last_printed != (rev, file, line_num - 1):
+                    print('--')
+                last_printed = (rev, file, line_num)
+
+                # Format output. Context lines use '-' instead of ':' like grep.
+                sep = ':' if tags else '-'
+                parts = []
+                if args.revs:
+                    # Like git grep does for trees
+                    parts.append(f"{rev[:12]}:")
+                parts.append(file)
+                if args.line_number:
+                    parts.append(f"{sep}{line_num}")
+                if args.show_author:
+                    parts.append(f" ({author})")
+                if tags and len(patterns) > 1:
+                    # Tell which of the patterns matched
+                    parts.append(f" [{', '.join(tags)}]")
+                parts.append(f"{sep} {line_content}")
+
+                print(''.join(parts))
+
+        previous = current
+
+    if counts is not None:
+        print_counts(counts, args.count_by, args.format)
 
-        for file, line_num, author, line_content in matches:
-            total_matches += 1
+    if pool is not None:
+        pool.shutdown()
+    reader.close()
+    if index is not None:
+        index.close()
+    if classifier is not None and classifier.summary():
+        print(classifier.summary(), file=sys.stderr)
 
-            # Format output
-            parts = [file]
-            if args.line_number:
-                parts.append(f":{line_num}")
-            if args.show_author:
-                parts.append(f" ({author})")
-            parts.append(f": {line_content}")
+    if cache is not None:
+        cache.evict()
+        if args.cache_stats:
+            print(cache.stats(), file=sys.stderr)
+        cache.close()
+    elif args.cache_stats:
+        print("Blame cache: disabled", file=sys.stderr)
 
-            print(''.join(parts))
+    if args.stats:
+        print(stats.report(total_matches), file=sys.stderr)
 
     return 0 if total_matches > 0 else 1
 
@@ -0,0 +1,60 @@
+"""Tests for git-blamegrep. Run with: python -m unittest discover git-blamegrep"""
+
+import importlib.util
+import unittest
+from pathlib import Path
+
+
+def load_blamegrep():
+    """Import git-blamegrep.py as a module. The file name isn't a valid module name."""
+    spec = importlib.util.spec_from_file_location('blamegrep', Path(__file__).with_name('git-blamegrep.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+blamegrep = load_blamegrep()
+
+
+class PcreAgreesTest(unittest.TestCase):
+    def assertAgrees(self, pattern, ignore_case=False):
+        self.assertTrue(blamegrep.pcre_agrees(pattern, ignore_case), pattern)
+
+    def assertDisagrees(self, pattern, ignore_case=False):
+        self.assertFalse(blamegrep.pcre_agrees(pattern, ignore_case), pattern)
+
+    def test_plain_patterns(self):
+        for pattern in ['TODO', 'foo.*bar', 'lookup\\(', '\\.', '[^x]+', '[]a]', '^import ']:
+            self.assertAgrees(pattern)
+
+    def test_unicode_aware_classes(self):
+        for pattern in ['\\wTODO', 'a\\b', '\\d+', '\\s', '\\x41', '\\u00e4', '\\N{BULLET}']:
+            self.assertDisagrees(pattern)
+
+    def test_non_ascii(self):
+        self.assertDisagrees('äbc')
+
+    def test_single_character_wildcards(self):
+        for pattern in ['a.b', 'a.?b', '[^x]', 'a[^x]{2}']:
+            self.assertDisagrees(pattern)
+
+    def test_end_anchors(self):
+        # git grep sees the \r of CRLF lines, blame output doesn't
+        self.assertDisagrees('TODO$')
+        self.assertDisagrees('TODO\\Z')
+        self.assertAgrees('costs \\$5')
+        self.assertAgrees('[$]')
+
+    def test_python_only_repeat(self):
+        self.assertDisagrees('x{,3}')
+
+    def test_ignore_case_folds(self):
+        self.assertAgrees('abc', ignore_case=True)
+        self.assertAgrees('[l-r]', ignore_case=True)
+        for pattern in ['k', 'TODO: fix', '[a-z]']:
+            self.assertDisagrees(pattern, ignore_case=True)
+        self.assertDisagrees('(?i)k')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,214 @@
+"""Import toots from a Mastodon account export into the SQLite database."""
+
+from __future__ import annotations
+
+import argparse
+import io
+import json
+import sqlite3
+import zipfile
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, TextIO, Tuple
+
+import masto_throwback
+
+
+# Statuses inserted per transaction
+BATCH_SIZE = 1000
+
+# Characters read from the export at a time
+CHUNK_SIZE = 1 << 16
+
+
+def iter_ordered_items(stream: TextIO) -> Iterator[Dict[str, Any]]:
+    """Yield the items of the orderedItems array of an ActivityStreams collection.
+
+    The JSON is read in chunks and each item is decoded on its own, so only
+    one item and one chunk are held in memory at a time.
+    """
+    decoder = json.JSONDecoder()
+    key = '"orderedItems"'
+    buffer = ""
+
+    # Skip to the start of the array
+    while True:
+        start = buffer.find(key)
+        if start >= 0:
+            bracket = buffer.find("[", start + len(key))
+            if bracket >= 0:
+                buffer = buffer[bracket + 1:]
+                break
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        # Keep the key if it was found, or the end of the buffer in case the
+        # key is split between chunks
+        buffer = (buffer[start:] if start >= 0 else buffer[-len(key):]) + chunk
+
+    pos = 0
+    eof = False
+    while True:
+        # Skip whitespace and the commas between items
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos < len(buffer) and buffer[pos] == "]":
+            return
+
+        try:
+            if pos >= len(buffer):
+                raise json.JSONDecodeError("Need more data", buffer, pos)
+            item, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # The item continues in the next chunk
+            if eof:
+                raise
+            chunk = stream.read(CHUNK_SIZE)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+        yield item
+
+
+def open_outbox(export_path: Path) -> TextIO:
+    """Open outbox.json from an export .zip, or an extracted outbox.json."""
+    if zipfile.is_zipfile(export_path):
+        archive = zipfile.ZipFile(export_path)
+        names = [name for name in archive.namelist() if name.rsplit("/", 1)[-1] == "outbox.json"]
+        if not names:
+            raise SystemExit(f"No outbox.json in {export_path}")
+        return io.TextIOWrapper(archive.open(names[0]), encoding="utf-8")
+    return export_path.open(encoding="utf-8")
+
+
+def status_id(uri: str) -> str:
+    """Return the id of a status from its ActivityPub URI, e.g. https://example.social/users/me/statuses/123."""
+    return uri.rstrip("/").rsplit("/", 1)[-1]
+
+
+def to_status(item: Dict[str, Any]) -> Optional[Tuple[str, Optional[str], str, str, Optional[str]]]:
+    """Convert a Create activity to a statuses row.
+
+    Returns (id, url, content, created_at, in_reply_to_id), or None for
+    other activities such as boosts. Replies to the account's own toots
+    refer to them by id; replies to other toots keep the full URI, which
+    doesn't match any id in the database.
+    """
+    if item.get("type") != "Create":
+        return None
+    note = item.get("object")
+    if not isinstance(note, dict) or note.get("type") not in ("Note", "Question"):
+        return None
+
+    own_prefix = note["id"].rsplit("/", 1)[0] + "/"
+    in_reply_to = note.get("inReplyTo")
+    if isinstance(in_reply_to, dict):
+        in_reply_to = in_reply_to.get("id")
+    if in_reply_to and in_reply_to.startswith(own_prefix):
+        in_reply_to = status_id(in_reply_to)
+
+    url = note.get("url")
+    if isinstance(url, list):
+        url = url[0] if url else None
+    if isinstance(url, dict):
+        url = url.get("href")
+
+    return (
+        status_id(note["id"]),
+        url,
+        note.get("content") or "",
+        note.get("published") or item.get("published") or "",
+        in_reply_to or None,
+    )
+
+
+def import_statuses(conn: sqlite3.Connection, items: Iterator[Dict[str, Any]]) -> Tuple[int, int]:
+    """Insert the toots of an export that aren't in the database yet.
+
+    Rows are inserted in batches of BATCH_SIZE, one transaction per batch.
+    Returns (number imported, number already present).
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS statuses (
+            id TEXT PRIMARY KEY,
+            url TEXT,
+            content TEXT,
+            created_at TEXT,
+            in_reply_to_id TEXT
+        )
+        """
+    )
+    existing = {str(row[0]) for row in conn.execute("SELECT id FROM statuses")}
+
+    imported = skipped = 0
+    batch: List[Tuple[str, Optional[str], str, str, Optional[str]]] = []
+
+    def flush() -> None:
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO statuses (id, url, content, created_at, in_reply_to_id) "
+                "VALUES (?, ?, ?, ?, ?)",
+                batch,
+            )
+        batch.clear()
+
+    for item in items:
+        row = to_status(item)
+        if row is None:
+            continue
+        if row[0] in existing:
+            skipped += 1
+            continue
+        existing.add(row[0])
+        batch.append(row)
+        imported += 1
+        if len(batch) >= BATCH_SIZE:
+            flush()
+    if batch:
+        flush()
+
+    return imported, skipped
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Import toots from a Mastodon account export into the SQLite database."
+    )
+    parser.add_argument(
+        "export",
+        type=Path,
+        help="Path to the export .zip or an extracted outbox.json.",
+    )
+    parser.add_argument(
+        "--db",
+        type=Path,
+        default=Path("/Users/miikka/code/miikkas-masto-history/masto.db"),
+        help="Path to the SQLite database file (default: /Users/miikka/code/miikkas-masto-history/masto.db).",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+
+    export_path = args.export.expanduser().resolve()
+    if not export_path.exists():
+        raise SystemExit(f"Export file does not exist: {export_path}")
+
+    db_path = args.db.expanduser().resolve()
+    conn = sqlite3.connect(db_path)
+    try:
+        with open_outbox(export_path) as outbox:
+            imported, skipped = import_statuses(conn, iter_ordered_items(outbox))
+        # Convert and index the new toots now instead of on the next throwback run
+        masto_throwback.ensure_indexes(conn)
+        masto_throwback.ensure_plain_text(conn)
+    finally:
+        conn.close()
+
+    print(f"Imported {imported} new toot(s), skipped {skipped} already in the database.")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,15 +5,18 @@ from __future__ import annotations
 import argparse
 import calendar
 import datetime as dt
-import html
 import re
 import sqlite3
+from html.parser import HTMLParser
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple
 
 
 HEADER_LINE = "## Vanhat tuuttaukset"
 
+# Number of statuses converted to plain text per transaction
+PLAIN_TEXT_BATCH_SIZE = 1000
+
 
 def subtract_years(source: dt.date, years: int) -> dt.date:
     year = source.year - years
@@ -51,15 +54,193 @@ def gather_target_dates(today: dt.date) -> List[Tuple[str, dt.date]]:
     return targets
 
 
+class TextExtractor(HTMLParser):
+    """Collect the text content of HTML, reading it in one pass as it's fed."""
+
+    # Elements that separate words even without whitespace around them
+    BREAKS = {"br", "p", "div", "li", "blockquote", "pre"}
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.parts: List[str] = []
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> None:
+        if tag in self.BREAKS:
+            self.parts.append(" ")
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag in self.BREAKS:
+            self.parts.append(" ")
+
+    def handle_data(self, data: str) -> None:
+        self.parts.append(data)
+
+    def text(self) -> str:
+        return re.sub(r'\s+', ' ', "".join(self.parts)).strip()
+
+
 def strip_html_tags(html_content: str) -> str:
     """Remove HTML tags and decode HTML entities."""
-    # Remove HTML tags
-    text = re.sub(r'<[^>]+>', '', html_content)
-    # Decode HTML entities
-    text = html.unescape(text)
-    # Clean up whitespace
-    text = re.sub(r'\s+', ' ', text).strip()
-    return text
+    extractor = TextExtractor()
+    extractor.feed(html_content)
+    extractor.close()
+    return extractor.text()
+
+
+def thread_sizes(toots: Iterable[Tuple[str, Optional[str]]]) -> Dict[str, int]:
+    """Count the toots in each thread.
+
+    Takes (toot_id, in_reply_to_id) pairs in posting order. A toot starts a
+    thread unless it replies to a toot given before it. Returns a dict of
+    thread starter id -> number of toots in its thread, counting the starter
+    and all replies below it, in the order the starters were given.
+    Runs in time linear in the number of toots.
+    """
+    children: Dict[str, List[str]] = {}
+    starters: List[str] = []
+    seen = set()
+    reply_to: Dict[str, Optional[str]] = {}
+    for toot_id, in_reply_to_id in toots:
+        if in_reply_to_id is None or in_reply_to_id not in seen:
+            starters.append(toot_id)
+        seen.add(toot_id)
+        reply_to[toot_id] = in_reply_to_id
+
+    for toot_id, in_reply_to_id in reply_to.items():
+        if in_reply_to_id is not None and in_reply_to_id in reply_to:
+            children.setdefault(in_reply_to_id, []).append(toot_id)
+
+    sizes: Dict[str, int] = {}
+    for starter in starters:
+        # Iterative DFS so that deep reply chains don't hit the recursion limit
+        count = 0
+        stack = [starter]
+        while stack:
+            count += 1
+            stack.extend(children.get(stack.pop(), ()))
+        sizes[starter] = count
+    return sizes
+
+
+def ensure_indexes(conn: sqlite3.Connection) -> bool:
+    """Create the indexes the queries rely on, if the database allows it.
+
+    Returns whether the index for finding replies is available.
+    """
+    # created_at is in ISO format like "2023-02-25T04:37:28.762Z", so the
+    # first ten characters are the date. Queries must use the same expression
+    # for SQLite to pick up the index.
+    try:
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS statuses_created_date "
+            "ON statuses (substr(created_at, 1, 10))"
+        )
+        # For finding the replies of a toot when counting threads
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS statuses_in_reply_to_id "
+            "ON statuses (in_reply_to_id)"
+        )
+        conn.commit()
+    except sqlite3.OperationalError:
+        # Read-only database: the queries still work, just with table scans
+        pass
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'statuses_in_reply_to_id'"
+    ).fetchone() is not None
+
+
+def ensure_plain_text(conn: sqlite3.Connection) -> bool:
+    """Store the plain text of each status and index it for full-text search.
+
+    Adds a plain_text column and an FTS5 table (statuses_fts) kept up to
+    date by triggers, then converts the statuses that don't have plain text
+    yet. Only new statuses are converted on later runs. Returns whether the
+    plain_text column is available.
+    """
+    def has_column() -> bool:
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(statuses)")]
+        return "plain_text" in columns
+
+    try:
+        if not has_column():
+            conn.execute("ALTER TABLE statuses ADD COLUMN plain_text TEXT")
+        # Only holds the statuses still to convert, so that finding them
+        # doesn't scan the whole table on every run
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS statuses_plain_text_missing "
+            "ON statuses (plain_text) WHERE plain_text IS NULL"
+        )
+
+        fts_exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'statuses_fts'"
+        ).fetchone() is not None
+        if not fts_exists:
+            try:
+                conn.executescript(
+                    """
+                    CREATE VIRTUAL TABLE statuses_fts USING fts5(
+                        plain_text, content='statuses', content_rowid='rowid'
+                    );
+                    CREATE TRIGGER statuses_fts_insert AFTER INSERT ON statuses BEGIN
+                        INSERT INTO statuses_fts (rowid, plain_text) VALUES (new.rowid, new.plain_text);
+                    END;
+                    CREATE TRIGGER statuses_fts_delete AFTER DELETE ON statuses BEGIN
+                        INSERT INTO statuses_fts (statuses_fts, rowid, plain_text)
+                        VALUES ('delete', old.rowid, old.plain_text);
+                    END;
+                    CREATE TRIGGER statuses_fts_update AFTER UPDATE OF plain_text ON statuses BEGIN
+                        INSERT INTO statuses_fts (statuses_fts, rowid, plain_text)
+                        VALUES ('delete', old.rowid, old.plain_text);
+                        INSERT INTO statuses_fts (rowid, plain_text) VALUES (new.rowid, new.plain_text);
+                    END;
+                    INSERT INTO statuses_fts (statuses_fts) VALUES ('rebuild');
+                    """
+                )
+            except sqlite3.OperationalError:
+                # SQLite built without FTS5: plain text still works
+                pass
+
+        while True:
+            rows = conn.execute(
+                "SELECT rowid, content FROM statuses WHERE plain_text IS NULL LIMIT ?",
+                (PLAIN_TEXT_BATCH_SIZE,)
+            ).fetchall()
+            if not rows:
+                break
+            with conn:
+                conn.executemany(
+                    "UPDATE statuses SET plain_text = ? WHERE rowid = ?",
+                    [(strip_html_tags(content) if content else "", rowid) for rowid, content in rows]
+                )
+        conn.commit()
+    except sqlite3.OperationalError:
+        # Read-only database: previews are converted on the fly
+        conn.rollback()
+    return has_column()
+
+
+def search_toots(db_path: Path, query: str, limit: int = 20) -> List[Tuple[str, str, str]]:
+    """Search all toots with an FTS5 query, best matches first.
+
+    Returns a list of tuples: (created_at, url, plain_text)
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        ensure_plain_text(conn)
+        return conn.execute(
+            """
+            SELECT s.created_at, s.url, s.plain_text
+            FROM statuses_fts
+            JOIN statuses s ON s.rowid = statuses_fts.rowid
+            WHERE statuses_fts MATCH ?
+            AND s.url IS NOT NULL
+            ORDER BY statuses_fts.rank
+            LIMIT ?
+            """,
+            (query, limit)
+        ).fetchall()
+    finally:
+        conn.close()
 
 
 def find_historical_toots(
@@ -74,85 +255,108 @@ def find_historical_toots(
     historical = []
 
     conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
-    for label, target_date in targets:
-        # Query for toots on this specific date
-        # The created_at field is in ISO format like "2023-02-25T04:37:28.762Z"
-        date_pattern = f"{target_date.isoformat()}%"
-
-        cursor.execute(
-            """
-            SELECT id, url, content, created_at, in_reply_to_id
-            FROM statuses
-            WHERE created_at LIKE ?
-            AND url IS NOT NULL
-            ORDER BY created_at
+    has_reply_index = ensure_indexes(conn)
+    plain_text_column = "s.plain_text" if ensure_plain_text(conn) else "NULL"
+
+    # Fetch the thread starters of all target dates at once, with the size
+    # of their whole thread, and group them by date. A reply to a toot from
+    # an earlier day is part of that day's thread, not a new one, and
+    # replies posted after midnight still count towards the thread.
+    dates = [target_date.isoformat() for _, target_date in targets]
+    toots_by_date: Dict[str, List[Tuple[str, str, str, int]]] = {}
+    rows: Iterable[Tuple[str, str, Optional[str], str, int]] = []
+    if dates and has_reply_index:
+        placeholders = ", ".join("?" for _ in dates)
+        rows = conn.execute(
+            f"""
+            WITH RECURSIVE
+            starters(id) AS (
+                SELECT s.id
+                FROM statuses s
+                WHERE substr(s.created_at, 1, 10) IN ({placeholders})
+                AND s.url IS NOT NULL
+                AND (
+                    s.in_reply_to_id IS NULL
+                    OR NOT EXISTS (
+                        SELECT 1 FROM statuses p
+                        WHERE p.id = s.in_reply_to_id AND p.url IS NOT NULL
+                    )
+                )
+            ),
+            -- UNION rather than UNION ALL stops at reply cycles
+            thread(root, id) AS (
+                SELECT id, id FROM starters
+                UNION
+                SELECT thread.root, r.id
+                FROM statuses r
+                JOIN thread ON r.in_reply_to_id = thread.id
+                WHERE r.url IS NOT NULL
+            )
+            SELECT s.url, s.content, {plain_text_column}, s.created_at, COUNT(*)
+            FROM thread
+            JOIN statuses s ON s.id = thread.root
+            GROUP BY thread.root
+            ORDER BY s.created_at
             """,
-            (date_pattern,)
+            dates
         )
+    elif dates:
+        # Without the index, every level of the recursive query above would
+        # scan the table, so read the reply links once and count in memory
+        sizes = thread_sizes(
+            (str(toot_id), None if in_reply_to_id is None else str(in_reply_to_id))
+            for toot_id, in_reply_to_id in conn.execute(
+                "SELECT id, in_reply_to_id FROM statuses WHERE url IS NOT NULL ORDER BY created_at"
+            )
+        )
+        placeholders = ", ".join("?" for _ in dates)
+        cursor = conn.execute(
+            f"""
+            SELECT s.id, s.url, s.content, {plain_text_column}, s.created_at
+            FROM statuses s
+            WHERE substr(s.created_at, 1, 10) IN ({placeholders})
+            AND s.url IS NOT NULL
+            ORDER BY s.created_at
+            """,
+            dates
+        )
+        rows = [
+            (url, content, plain_text, created_at, sizes[str(toot_id)])
+            for toot_id, url, content, plain_text, created_at in cursor
+            if str(toot_id) in sizes
+        ]
+
+    for url, content, plain_text, created_at, thread_count in rows:
+        # The plain text is stored unless the database is read-only
+        if plain_text is None:
+            plain_text = strip_html_tags(content) if content else ""
+        toots_by_date.setdefault(created_at[:10], []).append((url, plain_text, created_at, thread_count))
 
-        toots = cursor.fetchall()
-
-        # Build a map of toot_id -> toot data
-        toot_map = {}
-        for toot_id, url, content, created_at, in_reply_to_id in toots:
-            toot_map[toot_id] = {
-                'url': url,
-                'content': content,
-                'created_at': created_at,
-                'in_reply_to_id': in_reply_to_id,
-                'is_thread_start': in_reply_to_id is None or in_reply_to_id not in toot_map
-            }
-
-        # For each thread starter, count how many toots are in the thread
-        for toot_id, toot_data in toot_map.items():
-            if not toot_data['is_thread_start']:
-                continue  # Skip replies, only process thread starters
-
-            # Count toots in this thread
-            thread_count = 1
-            for other_id, other_data in toot_map.items():
-                if other_id == toot_id:
-                    continue
-                # Check if this toot is part of the thread (replies to any toot in thread)
-                current_reply_to = other_data['in_reply_to_id']
-                while current_reply_to:
-                    if current_reply_to == toot_id:
-                        thread_count += 1
-                        break
-                    # Check if replying to another toot in our thread
-                    if current_reply_to in toot_map:
-                        current_reply_to = toot_map[current_reply_to]['in_reply_to_id']
-                    else:
-                        break
-
-            # Strip HTML tags and get preview text
-            preview = strip_html_tags(toot_data['content']) if toot_data['content'] else ""
-
+    for label, target_date in targets:
+        for url, preview, created_at, thread_count in toots_by_date.get(target_date.isoformat(), []):
             if preview:
-                historical.append((label, toot_data['url'], preview, thread_count))
+                historical.append((label, url, preview, thread_count))
 
     conn.close()
     return historical
 
 
-def append_toots(
-    today_note: Path,
+def build_toots_block(
+    existing_content: str,
     historical_toots: List[Tuple[str, str, str, int]],
-    *,
-    dry_run: bool = False,
-) -> int:
-    """Append historical toots to today's note."""
-    existing_content = today_note.read_text(encoding="utf-8") if today_note.exists() else ""
+) -> Tuple[str, int]:
+    """Build the Markdown block of toots to append to a note.
 
+    Returns the block and the number of toots in it. Toots that are already
+    in the note are left out.
+    """
     new_lines: List[str] = []
     if existing_content and not existing_content.endswith("\n"):
         new_lines.append("")
 
     # Add toots section header if needed
     if not historical_toots:
-        return 0
+        return "", 0
 
     if HEADER_LINE not in existing_content:
         new_lines.extend(["", HEADER_LINE, ""])
@@ -181,9 +385,23 @@ def append_toots(
         toots_appended += 1
 
     if not new_lines or toots_appended == 0:
-        return 0
+        return "", 0
+
+    return "\n".join(new_lines) + "\n", toots_appended
 
-    block = "\n".join(new_lines) + "\n"
+
+def append_toots(
+    today_note: Path,
+    historical_toots: List[Tuple[str, str, str, int]],
+    *,
+    dry_run: bool = False,
+) -> int:
+    """Append historical toots to today's note."""
+    existing_content = today_note.read_text(encoding="utf-8") if today_note.exists() else ""
+
+    block, toots_appended = build_toots_block(existing_content, historical_toots)
+    if toots_appended == 0:
+        return 0
 
     if dry_run:
         print(block, end="")
@@ -237,6 +455,11 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="Print the Markdown that would be appended without modifying the file.",
     )
+    parser.add_argument(
+        "--search",
+        metavar="QUERY",
+        help="Print the toots matching a full-text search query instead of appending anything.",
+    )
     return parser.parse_args()
 
 
@@ -251,6 +474,15 @@ def main() -> None:
     if not db_path.exists():
         raise SystemExit(f"Database file does not exist: {db_path}")
 
+    if args.search:
+        try:
+            results = search_toots(db_path, args.search)
+        except sqlite3.OperationalError as e:
+            raise SystemExit(f"Search failed: {e}")
+        for created_at, url, plain_text in results:
+            print(f"- {created_at[:10]}: {plain_text} ([mastodon]({url}))")
+        return
+
     target_date: dt.date = args.date
     diary_dir = args.diary_dir.strip("/")
 
@@ -0,0 +1,218 @@
+"""Add every throwback section to today's Obsidian note with a single write.
+
+The sources run concurrently, and the note is read once and replaced
+atomically once, instead of once per script.
+"""
+
+from __future__ import annotations
+
+import argparse
+import datetime as dt
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import masto_throwback
+import throwback
+
+
+# A source builds the block it wants to append to the note from the note's
+# current content. Returns the block and the number of entries in it.
+Source = Callable[[argparse.Namespace, dt.date, str], Tuple[str, int]]
+
+
+def diary_source(args: argparse.Namespace, today: dt.date, existing_content: str) -> Tuple[str, int]:
+    """Links to old diary notes and archived entries."""
+    # Each source runs in its own thread, which needs its own connection
+    if args.no_index:
+        index = throwback.VaultIndex(args.vault, args.diary_dir)
+    else:
+        index = throwback.VaultIndex.open(args.index.expanduser(), args.vault, args.diary_dir)
+    try:
+        targets = throwback.gather_targets(today)
+        return throwback.build_links(existing_content, args.diary_dir, targets, index, args.preview)
+    finally:
+        index.close()
+
+
+def masto_source(args: argparse.Namespace, today: dt.date, existing_content: str) -> Tuple[str, int]:
+    """Toots posted on the same day in earlier years."""
+    if not args.db.exists():
+        raise SystemExit(f"Database file does not exist: {args.db}")
+    targets = masto_throwback.gather_target_dates(today)
+    historical_toots = masto_throwback.find_historical_toots(args.db, targets)
+    return masto_throwback.build_toots_block(existing_content, historical_toots)
+
+
+# Name -> (source, what it adds). Sections are added in this order.
+SOURCES: Dict[str, Tuple[Source, str]] = {
+    "diary": (diary_source, "diary link(s)"),
+    "masto": (masto_source, "toot(s)"),
+}
+
+
+def write_atomically(path: Path, content: str) -> None:
+    """Replace the contents of path so that readers see either the old or the new file."""
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(content)
+        if path.exists():
+            os.chmod(tmp_name, path.stat().st_mode)
+        else:
+            # mkstemp creates the file as 0600; give a new note the usual mode
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_name, 0o666 & ~umask)
+        os.replace(tmp_name, path)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+        raise
+
+
+def collect_blocks(
+    args: argparse.Namespace,
+    names: List[str],
+    today: dt.date,
+    existing_content: str,
+) -> Tuple[List[Tuple[str, str, int]], List[Tuple[str, str]]]:
+    """Run the named sources concurrently.
+
+    A source that fails doesn't stop the others. Returns (name, block,
+    count) for each source that succeeded and (name, error) for each one
+    that failed, in the given order.
+    """
+    results: List[Tuple[str, str, int]] = []
+    failures: List[Tuple[str, str]] = []
+    with ThreadPoolExecutor(max_workers=len(names)) as pool:
+        futures = [
+            pool.submit(SOURCES[name][0], args, today, existing_content)
+            for name in names
+        ]
+        for name, future in zip(names, futures):
+            try:
+                results.append((name, *future.result()))
+            except (Exception, SystemExit) as e:
+                failures.append((name, str(e) or type(e).__name__))
+    return results, failures
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Append all throwback sections to today's Obsidian note."
+    )
+    parser.add_argument(
+        "vault",
+        type=Path,
+        help="Path to the Obsidian vault root directory.",
+    )
+    parser.add_argument(
+        "--sources",
+        default=",".join(SOURCES),
+        help=f"Comma-separated sources to run (default: {','.join(SOURCES)}).",
+    )
+    parser.add_argument(
+        "--db",
+        type=Path,
+        default=Path("/Users/miikka/code/miikkas-masto-history/masto.db"),
+        help="Path to the Mastodon SQLite database file (default: /Users/miikka/code/miikkas-masto-history/masto.db).",
+    )
+    parser.add_argument(
+        "--diary-dir",
+        default="diary",
+        help="Relative path from the vault root to the diary folder (default: diary).",
+    )
+    parser.add_argument(
+        "--date",
+        type=lambda s: dt.date.fromisoformat(s),
+        default=dt.date.today(),
+        help="Override today's date (ISO format YYYY-MM-DD).",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Print the Markdown that would be appended without modifying the file.",
+    )
+    parser.add_argument(
+        "--preview",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Quote the first N characters of each linked diary entry under its link.",
+    )
+    parser.add_argument(
+        "--index",
+        type=Path,
+        default=throwback.DEFAULT_INDEX,
+        help=f"Path to the index of diary and archive dates (default: {throwback.DEFAULT_INDEX}).",
+    )
+    parser.add_argument(
+        "--no-index",
+        action="store_true",
+        help="Look the dates up from the vault without reading or updating the index.",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+
+    args.vault = args.vault.expanduser().resolve()
+    if not args.vault.exists():
+        raise SystemExit(f"Vault path does not exist: {args.vault}")
+
+    names = [name.strip() for name in args.sources.split(",") if name.strip()]
+    unknown = [name for name in names if name not in SOURCES]
+    if unknown or not names:
+        raise SystemExit(f"Unknown sources: {', '.join(unknown)} (available: {', '.join(SOURCES)})")
+
+    if "masto" in names:
+        args.db = args.db.expanduser().resolve()
+
+    target_date: dt.date = args.date
+    args.diary_dir = args.diary_dir.strip("/")
+
+    diary_path = args.vault / args.diary_dir
+    diary_path.mkdir(parents=True, exist_ok=True)
+    today_note = diary_path / f"{target_date.isoformat()}.md"
+    existing_content = today_note.read_text(encoding="utf-8") if today_note.exists() else ""
+    if existing_content and not existing_content.endswith("\n"):
+        existing_content += "\n"
+
+    results, failures = collect_blocks(args, names, target_date, existing_content)
+    content = existing_content + "".join(block for _, block, _ in results)
+
+    if args.dry_run:
+        print("".join(block for _, block, _ in results), end="")
+    elif any(count for _, _, count in results) or not today_note.exists():
+        before = diary_path.stat()
+        write_atomically(today_note, content)
+        if "diary" in names and not args.no_index:
+            # Replacing the note changes the directory's mtime; keep the
+            # stored diary listing valid
+            index = throwback.VaultIndex.open(args.index.expanduser(), args.vault, args.diary_dir)
+            try:
+                index.record_notes([target_date], before)
+            finally:
+                index.close()
+
+    for name, _, count in results:
+        what = SOURCES[name][1]
+        if count == 0:
+            print(f"{name}: nothing to append.")
+        elif args.dry_run:
+            print(f"{name}: dry run: would append {count} {what}.")
+        else:
+            print(f"{name}: appended {count} {what}.")
+    for name, error in failures:
+        print(f"{name}: failed: {error}", file=sys.stderr)
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
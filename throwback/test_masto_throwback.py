@@ -0,0 +1,94 @@
+"""Tests for masto_throwback. Run with: python -m unittest discover throwback"""
+
+import datetime as dt
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import masto_throwback
+from masto_throwback import find_historical_toots, thread_sizes
+
+
+class ThreadSizesTest(unittest.TestCase):
+    def test_standalone_toots(self):
+        self.assertEqual(thread_sizes([("1", None), ("2", None)]), {"1": 1, "2": 1})
+
+    def test_forest(self):
+        toots = [
+            ("1", None),
+            ("2", None),
+            ("3", "1"),
+            ("4", "2"),
+            ("5", "3"),
+            ("6", "1"),
+            ("7", None),
+        ]
+        sizes = thread_sizes(toots)
+        self.assertEqual(sizes, {"1": 4, "2": 2, "7": 1})
+        # Starters come in the order they were given
+        self.assertEqual(list(sizes), ["1", "2", "7"])
+
+    def test_reply_to_missing_parent_starts_a_thread(self):
+        toots = [("1", "someone-else"), ("2", "1"), ("3", None)]
+        self.assertEqual(thread_sizes(toots), {"1": 2, "3": 1})
+
+    def test_deep_chain(self):
+        depth = 100_000
+        toots = [("0", None)] + [(str(i), str(i - 1)) for i in range(1, depth)]
+        self.assertEqual(thread_sizes(toots), {"0": depth})
+
+    def test_empty(self):
+        self.assertEqual(thread_sizes([]), {})
+
+
+class FindHistoricalTootsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = Path(self.tmp.name) / "masto.db"
+        conn = sqlite3.connect(self.db_path)
+        conn.execute(
+            "CREATE TABLE statuses (id TEXT PRIMARY KEY, url TEXT, content TEXT, "
+            "created_at TEXT, in_reply_to_id TEXT)"
+        )
+        conn.executemany(
+            "INSERT INTO statuses VALUES (?, ?, ?, ?, ?)",
+            [
+                ("1", "https://x/1", "<p>Thread</p>", "2025-03-01T22:00:00Z", None),
+                ("2", "https://x/2", "<p>Reply</p>", "2025-03-01T23:00:00Z", "1"),
+                # Replies after midnight count towards the thread
+                ("3", "https://x/3", "<p>Late</p>", "2025-03-02T01:00:00Z", "2"),
+                ("4", "https://x/4", "<p>Alone</p>", "2025-03-02T10:00:00Z", None),
+                ("5", "https://x/5", "<p>Other</p>", "2025-03-02T11:00:00Z", "https://elsewhere/9"),
+                ("6", "https://x/6", "<p>Old</p>", "2024-03-01T10:00:00Z", None),
+            ],
+        )
+        conn.commit()
+        conn.close()
+        self.targets = [
+            ("1 vuosi sitten", dt.date(2025, 3, 1)),
+            ("1 vuosi sitten", dt.date(2025, 3, 2)),
+            ("2 vuotta sitten", dt.date(2024, 3, 1)),
+        ]
+        self.expected = [
+            ("1 vuosi sitten", "https://x/1", "Thread", 3),
+            ("1 vuosi sitten", "https://x/4", "Alone", 1),
+            ("1 vuosi sitten", "https://x/5", "Other", 1),
+            ("2 vuotta sitten", "https://x/6", "Old", 1),
+        ]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_recursive_query(self):
+        self.assertEqual(find_historical_toots(self.db_path, self.targets), self.expected)
+
+    def test_without_reply_index(self):
+        # As with a read-only database, where the index can't be created
+        with mock.patch.object(masto_throwback, "ensure_indexes", return_value=False):
+            self.assertEqual(find_historical_toots(self.db_path, self.targets), self.expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,12 +5,25 @@ from __future__ import annotations
 import argparse
 import calendar
 import datetime as dt
+import os
+import re
+import sqlite3
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, Iterable, List, Set, Tuple
+
+import masto_throwback
 
 
 HEADER_LINE = "## Aikakapseli"
 
+# Sections that the throwback scripts add to notes. They aren't part of the entry.
+ADDED_SECTIONS = (HEADER_LINE, masto_throwback.HEADER_LINE)
+
+# Day headings in the yearly archive files, e.g. "## 2022-03-14"
+ARCHIVE_HEADING = re.compile(rb"^## (\d{4}-\d{2}-\d{2})", re.MULTILINE)
+
+DEFAULT_INDEX = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "throwback" / "index.sqlite"
+
 
 def subtract_months(source: dt.date, months: int) -> dt.date:
     year = source.year
@@ -43,25 +56,274 @@ def formatted_link(diary_dir: str, target_date: dt.date, archive_file: str | Non
     return f"[[{diary_dir}/{target_date.isoformat()}]]"
 
 
-def check_archive_file(vault_path: Path, target_date: dt.date) -> str | None:
-    """Check if a date exists in an archive file.
+def excerpt_text(text: str, length: int) -> str:
+    """Collapse whitespace and cut text to length characters."""
+    text = " ".join(text.split())
+    if len(text) > length:
+        return text[:length].rstrip() + "..."
+    return text
+
 
-    Returns the relative path to the archive file (e.g., 'archive/Notes 2022')
-    if the file exists and contains a heading for the target date, otherwise None.
+def read_excerpt(path: Path, offset: int, length: int, *, section: bool) -> str:
+    """Read the first length characters of a note, or of an archive section.
+
+    Starts reading at offset and reads only as much as is needed. For a
+    section, offset is the position of its heading, and the section ends at
+    the next "## " heading. For a note, YAML front matter and the sections
+    added by the throwback scripts are skipped.
+    """
+    # UTF-8 takes up to four bytes per character; leave room for the heading
+    chunk_size = max(length * 4, 256)
+    data = b""
+    with path.open("rb") as f:
+        f.seek(offset)
+        while True:
+            chunk = f.read(chunk_size)
+            data += chunk
+            text = data.decode("utf-8", errors="ignore")
+            complete = not chunk
+            if section:
+                _, _, text = text.partition("\n")
+                end = 0 if text.startswith("## ") else text.find("\n## ")
+            else:
+                if text.startswith("---\n"):
+                    end = text.find("\n---", 3)
+                    if end < 0:
+                        if complete:
+                            return ""
+                        continue
+                    text = text[end + 4:]
+                # Stop at the first added section, whichever script added it
+                ends = [pos for pos in (text.find(header) for header in ADDED_SECTIONS) if pos >= 0]
+                end = min(ends, default=-1)
+            if end >= 0:
+                text = text[:end]
+                complete = True
+            if complete or len(" ".join(text.split())) > length:
+                return excerpt_text(text, length)
+
+
+def scan_archive(archive_file: Path) -> Dict[dt.date, int]:
+    """Find the day headings in an archive file.
+
+    Returns a dict of date -> byte offset of the first heading for that date.
     """
-    year = target_date.year
-    archive_file = vault_path / "archive" / f"Notes {year}.md"
+    headings: Dict[dt.date, int] = {}
+    for match in ARCHIVE_HEADING.finditer(archive_file.read_bytes()):
+        try:
+            heading_date = dt.date.fromisoformat(match.group(1).decode("ascii"))
+        except ValueError:
+            continue
+        headings.setdefault(heading_date, match.start())
+    return headings
+
 
-    if not archive_file.exists():
+class VaultIndex:
+    """Dates of the diary notes and the archive headings of a vault.
+
+    Each archive file is read at most once per run. With a connection to an
+    index database, the results are also kept between runs: the headings of
+    an archive are reused until its mtime or size changes, and the diary
+    listing until the directory's mtime changes. Notes written by this tool
+    are added to the stored listing instead of invalidating it, and while
+    the listing is out of date, single notes are looked up with a stat
+    rather than by listing the directory again.
+    """
+
+    def __init__(self, vault_path: Path, diary_dir: str, conn: sqlite3.Connection | None = None) -> None:
+        self.vault_path = vault_path
+        self.diary_root = vault_path / diary_dir
+        self.conn = conn
+        self.notes: Set[dt.date] | None = None
+        self.notes_loaded = False
+        # Notes looked up one by one while the listing is out of date
+        self.checked: Dict[dt.date, bool] = {}
+        # Notes that this run will create but hasn't written yet
+        self.pending: Set[dt.date] = set()
+        self.years: Dict[int, Dict[dt.date, int]] = {}
+
+    @classmethod
+    def open(cls, index_path: Path, vault_path: Path, diary_dir: str) -> VaultIndex:
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(index_path)
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS dates (
+                path TEXT NOT NULL,
+                date TEXT NOT NULL,
+                offset INTEGER,
+                PRIMARY KEY (path, date)
+            );
+            """
+        )
+        return cls(vault_path, diary_dir, conn)
+
+    def close(self) -> None:
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def archive_file(self, year: int) -> Path:
+        return self.vault_path / "archive" / f"Notes {year}.md"
+
+    def load(self, path: Path) -> Tuple[os.stat_result | None, Dict[dt.date, int | None] | None]:
+        """Stat path and return the stored dates for it if they're still valid."""
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return None, {}
+        if self.conn is None:
+            return stat, None
+        row = self.conn.execute(
+            "SELECT mtime_ns, size FROM files WHERE path = ?", (str(path),)
+        ).fetchone()
+        if row != (stat.st_mtime_ns, stat.st_size):
+            return stat, None
+        rows = self.conn.execute("SELECT date, offset FROM dates WHERE path = ?", (str(path),))
+        return stat, {dt.date.fromisoformat(date): offset for date, offset in rows}
+
+    def store(self, path: Path, stat: os.stat_result, dates: Dict[dt.date, int | None]) -> None:
+        if self.conn is None:
+            return
+        with self.conn:
+            self.conn.execute("DELETE FROM dates WHERE path = ?", (str(path),))
+            self.conn.executemany(
+                "INSERT INTO dates (path, date, offset) VALUES (?, ?, ?)",
+                [(str(path), date.isoformat(), offset) for date, offset in dates.items()],
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files (path, mtime_ns, size) VALUES (?, ?, ?)",
+                (str(path), stat.st_mtime_ns, stat.st_size),
+            )
+
+    def stored_note_dates(self) -> Set[dt.date] | None:
+        """Return the stored diary listing, or None if it's out of date."""
+        if not self.notes_loaded:
+            _, dates = self.load(self.diary_root)
+            if dates is not None:
+                self.notes = set(dates)
+            self.notes_loaded = True
+        return self.notes
+
+    def note_dates(self) -> Set[dt.date]:
+        """Return the dates that have an individual note in the diary directory.
+
+        Lists the directory if the stored listing is out of date.
+        """
+        if self.stored_note_dates() is None:
+            stat, dates = self.load(self.diary_root)
+            if dates is None:
+                dates = {}
+                with os.scandir(self.diary_root) as entries:
+                    for entry in entries:
+                        stem, ext = os.path.splitext(entry.name)
+                        if ext != ".md":
+                            continue
+                        try:
+                            dates[dt.date.fromisoformat(stem)] = None
+                        except ValueError:
+                            continue
+                self.store(self.diary_root, stat, dates)
+            self.notes = set(dates)
+        return self.notes
+
+    def diary_stat(self) -> os.stat_result | None:
+        try:
+            return self.diary_root.stat()
+        except FileNotFoundError:
+            return None
+
+    def add_pending_note(self, target_date: dt.date) -> None:
+        """Count a note that this run is going to create as existing."""
+        self.pending.add(target_date)
+
+    def record_notes(self, dates: Iterable[dt.date], before: os.stat_result | None) -> None:
+        """Add notes that this tool has just created to the stored listing.
+
+        before is the stat of the diary directory from before the notes were
+        written. If the stored listing was up to date then, it stays valid
+        despite the directory's new mtime.
+        """
+        dates = list(dates)
+        if self.notes is not None:
+            self.notes.update(dates)
+        for target_date in dates:
+            self.checked[target_date] = True
+        self.pending.difference_update(dates)
+        if self.conn is None or before is None:
+            return
+        key = str(self.diary_root)
+        row = self.conn.execute("SELECT mtime_ns, size FROM files WHERE path = ?", (key,)).fetchone()
+        if row != (before.st_mtime_ns, before.st_size):
+            return
+        stat = self.diary_root.stat()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO dates (path, date, offset) VALUES (?, ?, NULL)",
+                [(key, target_date.isoformat()) for target_date in dates],
+            )
+            self.conn.execute(
+                "UPDATE files SET mtime_ns = ?, size = ? WHERE path = ?",
+                (stat.st_mtime_ns, stat.st_size, key),
+            )
+
+    def headings(self, year: int) -> Dict[dt.date, int]:
+        """Return the day headings of the archive file for a year with their byte offsets."""
+        if year not in self.years:
+            archive_file = self.archive_file(year)
+            stat, headings = self.load(archive_file)
+            if headings is None:
+                headings = scan_archive(archive_file)
+                self.store(archive_file, stat, headings)
+            self.years[year] = headings
+        return self.years[year]
+
+    def has_note(self, target_date: dt.date) -> bool:
+        if target_date in self.pending:
+            return True
+        notes = self.stored_note_dates()
+        if notes is not None:
+            return target_date in notes
+        # Looking up a few notes is cheaper than listing the whole directory again
+        if target_date not in self.checked:
+            self.checked[target_date] = (self.diary_root / f"{target_date.isoformat()}.md").exists()
+        return self.checked[target_date]
+
+    def find(self, target_date: dt.date) -> str | None:
+        """Check if a date exists in an archive file.
+
+        Returns the relative path to the archive file (e.g., 'archive/Notes 2022')
+        if the file exists and contains a heading for the target date, otherwise None.
+        """
+        if target_date in self.headings(target_date.year):
+            return f"archive/Notes {target_date.year}"
         return None
 
-    content = archive_file.read_text(encoding="utf-8")
-    heading = f"## {target_date.isoformat()}"
+    def offset(self, target_date: dt.date) -> int | None:
+        """Return the byte offset of the heading for a date in its archive file."""
+        return self.headings(target_date.year).get(target_date)
 
-    if heading in content:
-        return f"archive/Notes {year}"
+    def excerpt(self, target_date: dt.date, length: int) -> str:
+        """Return the first length characters of the entry for a date.
 
-    return None
+        The entry is the individual note if there is one, otherwise the
+        section under the date's heading in the archive file.
+        """
+        if target_date in self.pending:
+            # The note isn't written yet, and it will only have links, which
+            # aren't part of the entry
+            return ""
+        if self.has_note(target_date):
+            return read_excerpt(self.diary_root / f"{target_date.isoformat()}.md", 0, length, section=False)
+        offset = self.offset(target_date)
+        if offset is None:
+            return ""
+        return read_excerpt(self.archive_file(target_date.year), offset, length, section=True)
 
 
 def gather_targets(today: dt.date) -> List[Tuple[str, dt.date]]:
@@ -79,17 +341,19 @@ def gather_targets(today: dt.date) -> List[Tuple[str, dt.date]]:
     return targets
 
 
-def append_links(
-    today_note: Path,
-    vault_path: Path,
+def build_links(
+    existing_content: str,
     diary_dir: str,
     targets: List[Tuple[str, dt.date]],
-    *,
-    dry_run: bool = False,
-) -> int:
-    diary_root = today_note.parent
-    existing_content = today_note.read_text(encoding="utf-8") if today_note.exists() else ""
-
+    index: VaultIndex,
+    preview: int = 0,
+) -> Tuple[str, int]:
+    """Build the Markdown block of links to append to a note.
+
+    If preview is given, the first preview characters of each linked entry
+    are quoted under its link. Returns the block and the number of links in
+    it. Links that are already in the note are left out.
+    """
     new_lines: List[str] = []
     if existing_content and not existing_content.endswith("\n"):
         new_lines.append("")
@@ -101,15 +365,14 @@ def append_links(
     diary_appended = 0
     for label, target_date in targets:
         # First check if individual diary note exists
-        target_path = diary_root / f"{target_date.isoformat()}.md"
         archive_file = None
 
-        if target_path.exists():
+        if index.has_note(target_date):
             # Individual diary note exists
             link = formatted_link(diary_dir, target_date)
         else:
             # Check if date exists in an archive file
-            archive_file = check_archive_file(vault_path, target_date)
+            archive_file = index.find(target_date)
             if not archive_file:
                 continue
             link = formatted_link(diary_dir, target_date, archive_file)
@@ -121,22 +384,105 @@ def append_links(
         new_lines.append(line)
         diary_appended += 1
 
+        if preview > 0:
+            excerpt = index.excerpt(target_date, preview)
+            if excerpt:
+                new_lines.append(f"    > {excerpt}")
+
     if not new_lines or diary_appended == 0:
-        return 0
+        return "", 0
 
-    block = "\n".join(new_lines) + "\n"
+    return "\n".join(new_lines) + "\n", diary_appended
 
-    if dry_run:
-        print(block, end="")
-        return diary_appended
 
+def with_block(existing_content: str, block: str) -> str:
     if not existing_content.endswith("\n"):
         existing_content += "\n"
+    return existing_content + block
+
+
+def append_links(
+    today_note: Path,
+    vault_path: Path,
+    diary_dir: str,
+    targets: List[Tuple[str, dt.date]],
+    *,
+    dry_run: bool = False,
+    index: VaultIndex | None = None,
+    preview: int = 0,
+) -> int:
+    if index is None:
+        index = VaultIndex(vault_path, diary_dir)
+    existing_content = today_note.read_text(encoding="utf-8") if today_note.exists() else ""
+
+    block, diary_appended = build_links(existing_content, diary_dir, targets, index, preview)
+    if diary_appended == 0:
+        return 0
+
+    if dry_run:
+        print(block, end="")
+        return diary_appended
 
-    today_note.write_text(existing_content + block, encoding="utf-8")
+    today_note.write_text(with_block(existing_content, block), encoding="utf-8")
     return diary_appended
 
 
+def backfill_links(
+    vault_path: Path,
+    diary_dir: str,
+    start: dt.date,
+    end: dt.date,
+    *,
+    dry_run: bool = False,
+    index: VaultIndex | None = None,
+    preview: int = 0,
+) -> List[Tuple[dt.date, int]]:
+    """Append links to the notes of every day from start to end, inclusive.
+
+    The targets of all days are looked up from the same index, and the notes
+    are only written once every day has been computed. A note is created
+    only for a day that gets links, and it then counts as an existing note
+    for the later days, as if the days had been run one by one.
+
+    Returns a list of (date, number of links) for each day.
+    """
+    if index is None:
+        index = VaultIndex(vault_path, diary_dir)
+    # A range looks up many notes, so list the directory once
+    index.note_dates()
+
+    report: List[Tuple[dt.date, int]] = []
+    updates: List[Tuple[Path, str]] = []
+    created: List[dt.date] = []
+    day = start
+    while day <= end:
+        note = index.diary_root / f"{day.isoformat()}.md"
+        exists = note.exists()
+        existing_content = note.read_text(encoding="utf-8") if exists else ""
+        block, count = build_links(existing_content, diary_dir, gather_targets(day), index, preview)
+        report.append((day, count))
+
+        if count:
+            if dry_run:
+                print(f"{day.isoformat()}: {count} diary link(s)")
+                print(block, end="")
+                print()
+            updates.append((note, with_block(existing_content, block)))
+            if not exists:
+                index.add_pending_note(day)
+                created.append(day)
+        day += dt.timedelta(days=1)
+
+    if not dry_run:
+        before = index.diary_stat()
+        index.diary_root.mkdir(parents=True, exist_ok=True)
+        for note, content in updates:
+            note.write_text(content, encoding="utf-8")
+        index.record_notes(created, before)
+
+    return report
+
+
 def resolve_today_note(vault_path: Path, diary_dir: str, target_date: dt.date) -> Path:
     diary_path = vault_path / diary_dir
     diary_path.mkdir(parents=True, exist_ok=True)
@@ -166,11 +512,41 @@ def parse_args() -> argparse.Namespace:
         default=dt.date.today(),
         help="Override today's date (ISO format YYYY-MM-DD).",
     )
+    parser.add_argument(
+        "--from",
+        dest="from_date",
+        type=lambda s: dt.date.fromisoformat(s),
+        help="Backfill the notes of every day from this date (ISO format YYYY-MM-DD).",
+    )
+    parser.add_argument(
+        "--to",
+        dest="to_date",
+        type=lambda s: dt.date.fromisoformat(s),
+        help="Last day to backfill with --from (default: --date).",
+    )
     parser.add_argument(
         "--dry-run",
         action="store_true",
         help="Print the Markdown that would be appended without modifying the file.",
     )
+    parser.add_argument(
+        "--preview",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Quote the first N characters of each linked entry under its link.",
+    )
+    parser.add_argument(
+        "--index",
+        type=Path,
+        default=DEFAULT_INDEX,
+        help=f"Path to the index of diary and archive dates (default: {DEFAULT_INDEX}).",
+    )
+    parser.add_argument(
+        "--no-index",
+        action="store_true",
+        help="Look the dates up from the vault without reading or updating the index.",
+    )
     return parser.parse_args()
 
 
@@ -183,12 +559,41 @@ def main() -> None:
     target_date: dt.date = args.date
     diary_dir = args.diary_dir.strip("/")
 
-    today_note = resolve_today_note(vault_path, diary_dir, target_date)
-    targets = gather_targets(target_date)
+    if args.to_date and not args.from_date:
+        raise SystemExit("--to requires --from")
+    if args.from_date and args.from_date > (args.to_date or target_date):
+        raise SystemExit("--from must not be after --to")
 
-    diary_count = append_links(
-        today_note, vault_path, diary_dir, targets, dry_run=args.dry_run
-    )
+    if args.no_index:
+        index = VaultIndex(vault_path, diary_dir)
+    else:
+        index = VaultIndex.open(args.index.expanduser(), vault_path, diary_dir)
+    try:
+        if args.from_date:
+            report = backfill_links(
+                vault_path, diary_dir, args.from_date, args.to_date or target_date,
+                dry_run=args.dry_run, index=index, preview=args.preview,
+            )
+            diary_count = sum(count for _, count in report)
+            notes = sum(1 for _, count in report if count)
+            if diary_count == 0:
+                print("No historical entries found to append.")
+            elif args.dry_run:
+                print(f"Dry run: would append {diary_count} diary link(s) to {notes} note(s).")
+            else:
+                print(f"Appended {diary_count} diary link(s) to {notes} note(s).")
+            return
+
+        before = index.diary_stat()
+        today_note = resolve_today_note(vault_path, diary_dir, target_date)
+        index.record_notes([target_date], before)
+        targets = gather_targets(target_date)
+        diary_count = append_links(
+            today_note, vault_path, diary_dir, targets,
+            dry_run=args.dry_run, index=index, preview=args.preview,
+        )
+    finally:
+        index.close()
 
     if diary_count == 0:
         print("No historical entries found to append.")